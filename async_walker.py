@@ -0,0 +1,174 @@
+import os
+import time
+import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from walker import DirectoryWalker
+
+
+class AsyncDirectoryWalker(DirectoryWalker):
+    """Walks directory trees with many listings and stats in flight at once, for network filesystems.
+
+    Every scandir and stat costs a round trip on NFS and SMB, so instead of issuing them one at a time
+    the blocking calls run on a thread pool driven by an asyncio loop. At most concurrency calls are in
+    flight overall, and at most mount_concurrency per mount point (mount_limits overrides it per mount,
+    a directory on another device than its parent switches to the limit of its own mount). latency is
+    added to every blocking call, to try the walker against a local directory as if it were remote.
+    walk_into puts the same items as DirectoryWalker on the queue, but not in listing order, walk is
+    the inherited sequential walk."""
+    def __init__(self, exclusions, recursive = False, follow_symlinks = False, completed = None, known = None, concurrency = 32, mount_concurrency = 8, mount_limits = None, latency = 0):
+        super().__init__(exclusions, recursive, follow_symlinks, completed, known)
+        self.concurrency = max(1, concurrency)
+        self.mount_concurrency = max(1, mount_concurrency)
+        self.mount_limits = {os.path.normcase(os.path.abspath(path)): limit for path, limit in (mount_limits or {}).items()}
+        self.latency = latency
+        self.limit = None
+        self.mount_semaphores = {}
+
+    def walk_into(self, roots, work_queue):
+        asyncio.run(self._walk(roots, work_queue))
+
+    async def _walk(self, roots, work_queue):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers = self.concurrency))
+        self.limit = asyncio.Semaphore(self.concurrency)
+        self.mount_semaphores = {}
+        pending = set()
+
+        for root in roots:
+            if self.exclusions.skip_root(root):
+                await self._put(work_queue, ("error", f"Scan path \"{root}\" is excluded in settings, skipping it."))
+                continue
+
+            await self._schedule(root, self._mount_semaphore(root), None, pending, work_queue)
+
+        while pending:
+            if self.cancelled:
+                for task in pending:
+                    task.cancel()
+                break
+
+            done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                path, items, subdirectories, mount_semaphore, device = task.result()
+
+                for item in items:
+                    await self._put(work_queue, item)
+
+                if subdirectories is None: # Listing failed, so it's listed again on resume
+                    continue
+
+                if self.recursive:
+                    for subdirectory in subdirectories:
+                        await self._schedule(subdirectory, mount_semaphore, device, pending, work_queue)
+
+    async def _schedule(self, path, mount_semaphore, device, pending, work_queue):
+        # Directories completed in an interrupted scan aren't listed, their recorded subdirectories are walked instead
+        stack = [path]
+
+        while stack:
+            path = stack.pop()
+
+            if path not in self.completed:
+                pending.add(asyncio.create_task(self._list_directory_async(path, mount_semaphore, device)))
+                continue
+
+            await self._put(work_queue, ("resumed", path))
+
+            if self.recursive:
+                stack.extend(self.completed[path])
+
+    async def _list_directory_async(self, path, mount_semaphore, parent_device):
+        start = time.perf_counter()
+        items = []
+        subdirectories = []
+
+        try:
+            stat = await self._call(mount_semaphore, os.stat, path)
+
+            if parent_device is not None and stat.st_dev != parent_device: # A mount nested in the tree, it gets its own limit
+                mount_semaphore = self._mount_semaphore(path)
+
+            if self._already_visited(stat): # Checked on the loop thread, so the visited set needs no lock
+                return path, items, subdirectories, mount_semaphore, stat.st_dev
+
+            if self._unchanged(path, stat):
+                return path, [("unchanged", path)], list(self.known[path][1]), mount_semaphore, stat.st_dev
+
+            entries = await self._call(mount_semaphore, self._scandir, path)
+
+        except OSError as error:
+            items.append(("error", str(error)))
+            items.append(("unlisted", path))
+            return path, items, None, mount_semaphore, parent_device
+
+        for item in await asyncio.gather(*(self._check_entry_async(entry, mount_semaphore) for entry in entries)):
+            if item is None:
+                continue
+
+            if item[0] == "directory":
+                subdirectories.append(item[1])
+            else:
+                items.append(item)
+
+        files = sum(1 for kind, _ in items if kind == "file")
+        items.append(("listed", (path, subdirectories, stat.st_mtime, files + len(subdirectories))))
+
+        # Listings overlap, so the walk time adds up to more than the wall time
+        elapsed = time.perf_counter() - start
+        self.stats.add_time("walk", elapsed)
+        self.stats.count("directories_listed")
+        self.stats.record_slow("directories", path, elapsed)
+        return path, items, subdirectories, mount_semaphore, stat.st_dev
+
+    async def _check_entry_async(self, entry, mount_semaphore):
+        try:
+            if entry.is_file() and (self.follow_symlinks or not entry.is_symlink()):
+                # DirEntry caches its stat result, so the check below doesn't block the loop
+                await self._call(mount_semaphore, entry.stat)
+
+            item = self._check_entry(entry)
+        except OSError as error:
+            return ("error", str(error))
+
+        return ("directory", entry.path) if item == "directory" else item
+
+    async def _call(self, mount_semaphore, function, *args):
+        async with self.limit, mount_semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, self._blocking_call, function, args)
+
+    def _blocking_call(self, function, args):
+        if self.latency:
+            time.sleep(self.latency)
+
+        return function(*args)
+
+    def _scandir(self, path):
+        with os.scandir(path) as entries:
+            return list(entries)
+
+    async def _put(self, work_queue, item):
+        # The queue is bounded, when it's full the wait moves off the loop so listings already in flight keep going
+        try:
+            work_queue.put_nowait(item)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, work_queue.put, item)
+
+    def _mount_semaphore(self, path):
+        mount = os.path.abspath(path)
+
+        while not os.path.ismount(mount):
+            parent = os.path.dirname(mount)
+
+            if parent == mount:
+                break
+
+            mount = parent
+
+        mount = os.path.normcase(mount)
+
+        if mount not in self.mount_semaphores:
+            self.mount_semaphores[mount] = asyncio.Semaphore(self.mount_limits.get(mount, self.mount_concurrency))
+
+        return self.mount_semaphores[mount]
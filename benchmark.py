@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import platform
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime
+
+try: # Not available on Windows, peak RSS is left out there
+    import resource
+except ImportError:
+    resource = None
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json")
+SONG_INI = "[song]\nname = {name}\nartist = {artist}\ncharter = {charter}\ndiff_guitar = {difficulty}\n"
+
+
+class LibraryGenerator:
+    """Generates a reproducible synthetic library, the same parameters and seed always give the same tree.
+
+    Generic files get log-normally distributed sizes and are spread over nested directories, Clone Hero
+    style song folders repeat the same filenames (song.ini, notes.chart, song.ogg, album.png) in every
+    folder. A share of files and song folders are exact copies of earlier ones."""
+    def __init__(self, files = 1000, songs = 200, duplicate_ratio = 0.2, depth = 3, median_kb = 256, sigma = 1.5, seed = 1):
+        self.params = {
+            "files": files,
+            "songs": songs,
+            "duplicate_ratio": duplicate_ratio,
+            "depth": depth,
+            "median_kb": median_kb,
+            "sigma": sigma,
+            "seed": seed
+        }
+        self.rng = random.Random(seed)
+        self.total_files = 0
+        self.total_bytes = 0
+
+    def generate(self, root):
+        if os.path.exists(root):
+            shutil.rmtree(root)
+
+        os.makedirs(root)
+        generated = []
+
+        for i in range(self.params["files"]):
+            directory = self._random_directory(root)
+            path = os.path.join(directory, f"file_{i}{self.rng.choice(['.bin', '.dat', '.txt', '.ogg', '.png'])}")
+
+            if generated and self.rng.random() < self.params["duplicate_ratio"]:
+                shutil.copyfile(self.rng.choice(generated), path)
+            else:
+                size = int(self.rng.lognormvariate(0, self.params["sigma"]) * self.params["median_kb"] * 1024)
+                self._write_random(path, size)
+                generated.append(path)
+
+            self._count(path)
+
+        songs = []
+
+        for i in range(self.params["songs"]):
+            directory = os.path.join(self._random_directory(root), f"Artist {i % 50} - Song {i}")
+
+            if songs and self.rng.random() < self.params["duplicate_ratio"]:
+                shutil.copytree(self.rng.choice(songs), directory)
+            else:
+                self._write_song(directory, i)
+                songs.append(directory)
+
+            for name in os.listdir(directory):
+                self._count(os.path.join(directory, name))
+
+        self._backdate(root)
+        return {**self.params, "total_files": self.total_files, "total_bytes": self.total_bytes}
+
+    def _write_song(self, directory, index):
+        os.makedirs(directory)
+
+        with open(os.path.join(directory, "song.ini"), "w") as file:
+            file.write(SONG_INI.format(name = f"Song {index}", artist = f"Artist {index % 50}", charter = f"Charter {index % 7}", difficulty = self.rng.randint(0, 6)))
+
+        self._write_random(os.path.join(directory, "notes.chart"), self.rng.randint(20, 120) * 1024)
+        self._write_random(os.path.join(directory, "song.ogg"), self.rng.randint(2, 8) * 1024**2)
+        self._write_random(os.path.join(directory, "album.png"), self.rng.randint(50, 500) * 1024)
+
+    def _backdate(self, root):
+        # A freshly written tree is younger than the mtime granularity, so the warm scan would list every
+        # directory again instead of skipping the unchanged ones like it does on a real library
+        backdated = time.time() - 3600
+
+        for directory, _, _ in os.walk(root):
+            os.utime(directory, (backdated, backdated))
+
+    def _random_directory(self, root):
+        directory = root
+
+        for _ in range(self.rng.randint(0, self.params["depth"])):
+            directory = os.path.join(directory, f"dir_{self.rng.randint(0, 9)}")
+
+        os.makedirs(directory, exist_ok = True)
+        return directory
+
+    def _write_random(self, path, size):
+        with open(path, "wb") as file:
+            file.write(self.rng.randbytes(size))
+
+    def _count(self, path):
+        self.total_files += 1
+        self.total_bytes += os.path.getsize(path)
+
+
+def modify_library(root, ratio, seed):
+    """Touches a share of the files, half of them get bytes appended and half are rewritten at the same size.
+    Their directories get a new mtime too, as when a file is saved through a temporary file and renamed, so
+    the scan lists them again (plain in-place edits are only noticed with "paranoid_rescan")."""
+    rng = random.Random(seed)
+    paths = sorted(os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names)
+    modified = rng.sample(paths, int(len(paths) * ratio))
+
+    for i, path in enumerate(modified):
+        if i % 2:
+            with open(path, "ab") as file:
+                file.write(rng.randbytes(1024))
+        else:
+            size = os.path.getsize(path)
+
+            with open(path, "r+b") as file:
+                file.write(rng.randbytes(min(size, 1024)))
+
+            os.utime(path, (time.time() + 1, time.time() + 1)) # Same size, so make sure the mtime moves
+
+        os.utime(os.path.dirname(path))
+
+    return len(modified)
+
+
+def run_phase(library, work_dir, settings, library_stats):
+    # Runs in a fresh process so peak RSS belongs to this phase only
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from file_operations import FileOperations
+
+    os.chdir(work_dir) # Cache and report are relative to the working directory
+    start = time.perf_counter()
+    fo = FileOperations(dict(settings))
+    load_time = time.perf_counter() - start
+
+    write_times = []
+    cache_write = fo.cache.write
+
+    def timed_write():
+        write_start = time.perf_counter()
+        cache_write()
+        write_times.append(time.perf_counter() - write_start)
+
+    fo.cache.write = timed_write
+
+    start = time.perf_counter()
+    fo.scan_directory([library], True)
+    elapsed = time.perf_counter() - start
+
+    peak_rss = None
+    if resource is not None: # ru_maxrss is in KiB on Linux and bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if platform.system() == "Darwin" else 1024)
+
+    return {
+        "scan_seconds": elapsed,
+        "files_per_second": library_stats["total_files"] / elapsed,
+        "mb_per_second": library_stats["total_bytes"] / 1024**2 / elapsed,
+        "cache_load_seconds": load_time,
+        "cache_write_seconds": sum(write_times),
+        "peak_rss_bytes": peak_rss,
+        "errors": len(fo.error_dump),
+        "duplicates_found": fo.detected,
+        "phase_seconds": fo.last_stats.phases,
+        "counters": fo.last_stats.counters
+    }
+
+
+def run_benchmark(args):
+    with open(SETTINGS_PATH, "r") as file:
+        settings = json.load(file)
+
+    for override in args.set: # --set hash_algorithm=\"sha256\", values are JSON
+        key, value = override.split("=", 1)
+        settings[key] = json.loads(value)
+
+    generator = LibraryGenerator(args.files, args.songs, args.duplicate_ratio, args.depth, args.median_kb, args.sigma, args.seed)
+    library = os.path.abspath(args.library)
+    print(f"Generating library in \"{library}\"...")
+    library_stats = generator.generate(library)
+
+    results = {
+        "meta": {
+            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "settings": settings,
+        "library": library_stats,
+        "phases": {}
+    }
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for phase in ("cold", "warm", "modified"):
+            if phase == "modified":
+                results["library"]["modified_files"] = modify_library(library, args.modify_ratio, args.seed)
+
+            print(f"Running {phase} scan...")
+
+            with context.Pool(1) as pool:
+                results["phases"][phase] = pool.apply(run_phase, (library, work_dir, settings, library_stats))
+
+    if not args.keep_library:
+        shutil.rmtree(library)
+
+    return results
+
+
+def compare(baseline_path, current):
+    with open(baseline_path, "r") as file:
+        baseline = json.load(file)
+
+    print(f"\n{'PHASE':<10}{'METRIC':<22}{'BASELINE':>14}{'CURRENT':>14}{'CHANGE':>10}")
+
+    for phase, metrics in current["phases"].items():
+        for metric, value in metrics.items():
+            old = baseline["phases"].get(phase, {}).get(metric)
+
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or not old: # Skips the nested stats too
+                continue
+
+            print(f"{phase:<10}{metric:<22}{old:>14.2f}{value:>14.2f}{(value - old) / old:>+10.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks clone-sweeper scans on a generated library (cold cache, warm cache and after modifying some files).")
+    parser.add_argument("--files", type = int, default = 1000, help = "Generic files to generate")
+    parser.add_argument("--songs", type = int, default = 200, help = "Clone Hero style song folders to generate")
+    parser.add_argument("--duplicate-ratio", type = float, default = 0.2, help = "Share of files and song folders that are copies")
+    parser.add_argument("--depth", type = int, default = 3, help = "Max directory depth")
+    parser.add_argument("--median-kb", type = int, default = 256, help = "Median size of generic files")
+    parser.add_argument("--sigma", type = float, default = 1.5, help = "Spread of the log-normal file size distribution")
+    parser.add_argument("--modify-ratio", type = float, default = 0.05, help = "Share of files modified before the last scan")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--library", default = "./benchmark_library", help = "Where to generate the library")
+    parser.add_argument("--keep-library", action = "store_true")
+    parser.add_argument("--set", action = "append", default = [], metavar = "KEY=JSON", help = "Override a setting from settings.json")
+    parser.add_argument("--output", help = "Write the results as JSON to this file")
+    parser.add_argument("--compare", metavar = "BASELINE", help = "Compare the results against an earlier results file")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    output = json.dumps(results, indent = 4)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,604 @@
+import os
+import sys
 import json
+import hashlib
+import sqlite3
 from datetime import datetime
 from typing import List, Optional
+from stats import ScanStats
+
+
+class CacheError(Exception):
+    """Exceptions raised when a cache backend can't read its stored cache."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class FileRecord:
+    """A cached file, compact stand-in for the dict records used to be.
+
+    Attributes live in __slots__, the directory part of the path is interned so every file in a directory
+    shares one string, and digests are kept as bytes (half the size of hex strings, without the object
+    overhead of a dict per record). Reads and writes still go through the record keys ("PATH", "SIZE",
+    an algorithm name, ...) and digests come out as hex strings, so records can be used like the dicts
+    they replace. Keys that aren't file metadata or hex digests (like the song metadata) are kept as is."""
+    __slots__ = ("directory", "name", "mtime", "size", "device", "inode", "partial", "last_seen", "digests", "extra")
+    FIELDS = {"MODIFIED_TIME": "mtime", "SIZE": "size", "DEVICE": "device", "INODE": "inode", "LAST_SEEN": "last_seen"}
+
+    def __init__(self, path, mtime):
+        directory, self.name = os.path.split(path)
+        self.directory = sys.intern(directory)
+        self.mtime = mtime
+        self.size = None
+        self.device = None
+        self.inode = None
+        self.partial = None
+        self.last_seen = None
+        self.digests = () # Flat (algorithm, digest bytes, algorithm, ...), most records have none or one
+        self.extra = () # (key, value) pairs
+
+    @classmethod
+    def from_dict(cls, values):
+        record = cls(values["PATH"], values["MODIFIED_TIME"])
+        record.update(values)
+        return record
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, self.name)
+
+    def __repr__(self):
+        return f"FileRecord({self.to_dict()!r})"
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+
+        if value is KeyError:
+            raise KeyError(key)
+
+        return value
+
+    def get(self, key, default = None):
+        if key == "PATH":
+            return self.path
+
+        if key in self.FIELDS:
+            value = getattr(self, self.FIELDS[key])
+            return default if value is None else value
+
+        if key == "PARTIAL_HASH":
+            return default if self.partial is None else self.partial.hex()
+
+        for i in range(0, len(self.digests), 2):
+            if self.digests[i] == key:
+                return self.digests[i + 1].hex()
+
+        for name, value in self.extra:
+            if name == key:
+                return value
+
+        return default
+
+    def __contains__(self, key):
+        if key == "PATH":
+            return True
+
+        if key in self.FIELDS:
+            return getattr(self, self.FIELDS[key]) is not None
+
+        if key == "PARTIAL_HASH":
+            return self.partial is not None
+
+        return key in self.digests[::2] or any(name == key for name, _ in self.extra)
+
+    def __setitem__(self, key, value):
+        if key == "PATH":
+            directory, self.name = os.path.split(value)
+            self.directory = sys.intern(directory)
+        elif key == "DEVICE":
+            self.device = _DEVICES.setdefault(value, value) # Same few values on every record, shared like the directories
+        elif key in self.FIELDS:
+            setattr(self, self.FIELDS[key], value)
+        elif key == "PARTIAL_HASH":
+            self.partial = _digest_bytes(value)
+        else:
+            digest = _digest_bytes(value)
+            self._discard(key)
+
+            if digest is not None:
+                self.digests += (key, digest)
+            else:
+                self.extra += ((key, value),)
+
+    def pop(self, key, default = None):
+        value = self.get(key, default)
+
+        if key in self.FIELDS:
+            setattr(self, self.FIELDS[key], None)
+        elif key == "PARTIAL_HASH":
+            self.partial = None
+        else:
+            self._discard(key)
+
+        return value
+
+    def _discard(self, key):
+        if key in self.digests[::2]:
+            i = self.digests[::2].index(key) * 2
+            self.digests = self.digests[:i] + self.digests[i + 2:]
+
+        self.extra = tuple(pair for pair in self.extra if pair[0] != key)
+
+    def update(self, values):
+        for key, value in values.items():
+            self[key] = value
+
+    def items(self):
+        yield "PATH", self.path
+
+        for key, attribute in self.FIELDS.items():
+            value = getattr(self, attribute)
+
+            if value is not None:
+                yield key, value
+
+        if self.partial is not None:
+            yield "PARTIAL_HASH", self.partial.hex()
+
+        for i in range(0, len(self.digests), 2):
+            yield self.digests[i], self.digests[i + 1].hex()
+
+        yield from self.extra
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+_DEVICES = {}
+
+
+def _digest_bytes(value):
+    # Only lowercase hex that survives the round trip is stored as bytes, so every value reads back unchanged
+    if isinstance(value, bytes):
+        return value
+
+    if isinstance(value, str):
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return None
+
+        if digest.hex() == value:
+            return digest
+
+    return None
+
+
+class JsonCacheBackend:
+    """Stores the whole cache as a single JSON document, rewritten on every write."""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def load(self):
+        with open(self.file_path, "r") as file:
+            try:
+                cache_content = json.load(file)
+            except json.JSONDecodeError as e:
+                raise CacheError(f"invalid JSON: {e}")
+
+        records = [FileRecord.from_dict(values) for name_instances in (cache_content.get("data") or {}).values() for values in name_instances]
+        directories = {path: (mtime, entries, tuple(subdirectories)) for path, (mtime, entries, subdirectories) in (cache_content.get("directories") or {}).items()}
+        return cache_content.get("metadata"), records, directories
+
+    def write(self, metadata, records, changed=None, removed=None, directories=None, changed_directories=None):
+        data = {} # Same layout as before records were objects, records grouped by filename
+
+        for record in records:
+            data.setdefault(record.name, []).append(record.to_dict())
+
+        cache_structure = {
+            "metadata": metadata,
+            "data": data,
+            "directories": directories or {}
+            }
+        temp_path = self.file_path + ".tmp"
+
+        # Replaced in one step so a crash mid-write leaves the previous cache intact
+        with open(temp_path, "w") as file:
+            json.dump(cache_structure, file, indent = 4)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, self.file_path)
+
+    def close(self):
+        pass
+
+
+class SQLiteCacheBackend:
+    """Stores cache records as rows in an SQLite database.
+
+    File records are indexed on path and size, and their digests live in a separate table indexed on
+    (algorithm, digest), so digests of several algorithms can be kept side by side. Digests are stored
+    as blobs. Only records that changed since the last write are upserted, batched inside a single
+    transaction."""
+    BATCH_SIZE = 10000
+    SCHEMA_VERSION = 5
+    RECORD_KEYS = ("PATH", "MODIFIED_TIME", "SIZE", "DEVICE", "INODE", "PARTIAL_HASH", "LAST_SEEN") # Every other record key is an algorithm
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.connection = None
+
+    def exists(self):
+        return os.path.exists(self.file_path)
+
+    def _connect(self):
+        if self.connection is None:
+            # Callers serialize access (the daemon scans on its request threads), so the connection can move between threads
+            self.connection = sqlite3.connect(self.file_path, check_same_thread = False)
+            self.connection.execute("PRAGMA journal_mode=WAL") # Readers don't block the writer, and commits are appends
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    modified_time REAL,
+                    size INTEGER,
+                    device INTEGER,
+                    inode INTEGER,
+                    partial_hash BLOB,
+                    last_seen INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS digests (
+                    path TEXT,
+                    algorithm TEXT,
+                    digest BLOB,
+                    PRIMARY KEY (path, algorithm)
+                ) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS files_size ON files (size);
+                CREATE INDEX IF NOT EXISTS digests_algorithm_digest ON digests (algorithm, digest);
+                CREATE TABLE IF NOT EXISTS directories (
+                    path TEXT PRIMARY KEY,
+                    modified_time REAL,
+                    entries INTEGER,
+                    subdirectories TEXT
+                );
+                """)
+            self._upgrade_schema()
+
+        return self.connection
+
+    def _upgrade_schema(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+
+        if version < 1 and "last_seen" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN last_seen INTEGER")
+
+        if version < 2 and "hash" in columns: # Version 1 kept a single digest of the "hash_algorithm" metadata key in files
+            with self.connection:
+                row = self.connection.execute("SELECT value FROM metadata WHERE key = 'hash_algorithm'").fetchone()
+                hash_algorithm = json.loads(row[0]) if row else ""
+
+                if hash_algorithm:
+                    self.connection.execute("INSERT OR REPLACE INTO digests (path, algorithm, digest) SELECT path, ?, hash FROM files WHERE hash IS NOT NULL", (hash_algorithm,))
+
+                self.connection.execute("DROP INDEX IF EXISTS files_size_hash")
+                self.connection.execute("UPDATE files SET hash = NULL")
+
+                if sqlite3.sqlite_version_info >= (3, 35, 0): # DROP COLUMN support, otherwise the column is left empty
+                    self.connection.execute("ALTER TABLE files DROP COLUMN hash")
+
+        if version < 3 and "inode" not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN device INTEGER")
+            self.connection.execute("ALTER TABLE files ADD COLUMN inode INTEGER")
+
+        if version < 4: # Hex digests to blobs, values that aren't digests stay text
+            with self.connection:
+                self.connection.executemany("UPDATE files SET partial_hash = ? WHERE path = ?",
+                    ((_digest_bytes(partial_hash), path) for path, partial_hash in self.connection.execute("SELECT path, partial_hash FROM files WHERE typeof(partial_hash) = 'text'").fetchall()))
+                self.connection.executemany("UPDATE digests SET digest = ? WHERE path = ? AND algorithm = ?",
+                    ((_digest_bytes(digest), path, algorithm) for path, algorithm, digest in self.connection.execute("SELECT path, algorithm, digest FROM digests WHERE typeof(digest) = 'text'").fetchall() if _digest_bytes(digest) is not None))
+
+        # Version 5 only added the directories table, created with the others
+        self.connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def load(self):
+        if not self.exists():
+            raise FileNotFoundError(f"No cache database at {self.file_path}")
+
+        try:
+            connection = self._connect()
+            metadata = {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM metadata")}
+            records = {}
+
+            for path, modified_time, size, device, inode, partial_hash, last_seen in connection.execute("SELECT path, modified_time, size, device, inode, partial_hash, last_seen FROM files"):
+                record = FileRecord(path, modified_time)
+                record.size = size
+                record.device = _DEVICES.setdefault(device, device)
+                record.inode = inode
+                record.partial = partial_hash
+                record.last_seen = last_seen
+                records[path] = record
+
+            for path, algorithm, digest in connection.execute("SELECT path, algorithm, digest FROM digests"):
+                record = records.get(path)
+
+                if record is None:
+                    continue
+
+                if isinstance(digest, bytes):
+                    record.digests += (algorithm, digest)
+                else:
+                    record.extra += ((algorithm, digest),)
+
+            directories = {path: (modified_time, entries, tuple(json.loads(subdirectories)))
+                           for path, modified_time, entries, subdirectories in connection.execute("SELECT path, modified_time, entries, subdirectories FROM directories")}
+
+        except sqlite3.DatabaseError as e:
+            self.close()
+            os.replace(self.file_path, self.file_path + ".corrupt") # Kept aside so a new database can be created in its place
+            raise CacheError(str(e))
+
+        return metadata, list(records.values()), directories
+
+    def write(self, metadata, records, changed=None, removed=None, directories=None, changed_directories=None):
+        """Writes the metadata and the changed records, or every record in records if changed is None.
+        Directories are written the same way, all of them or the paths in changed_directories."""
+        connection = self._connect()
+        directories = directories or {}
+
+        if changed is None:
+            changed = records
+
+        records = iter(changed)
+
+        with connection: # One transaction for the whole write
+            if removed is None: # Full write, drop rows that are no longer in data
+                connection.execute("DELETE FROM files")
+                connection.execute("DELETE FROM digests")
+            else:
+                connection.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in removed))
+                connection.executemany("DELETE FROM digests WHERE path = ?", ((path,) for path in removed))
+
+            connection.executemany("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)", ((key, json.dumps(value)) for key, value in metadata.items()))
+
+            if changed_directories is None:
+                connection.execute("DELETE FROM directories")
+                changed_directories = directories
+
+            connection.executemany("DELETE FROM directories WHERE path = ?", ((path,) for path in changed_directories if path not in directories))
+            connection.executemany("INSERT OR REPLACE INTO directories (path, modified_time, entries, subdirectories) VALUES (?, ?, ?, ?)",
+                ((path, *directories[path][:2], json.dumps(directories[path][2])) for path in changed_directories if path in directories))
+
+            while True:
+                batch = [(record.path, record) for _, record in zip(range(self.BATCH_SIZE), records)]
+
+                if not batch:
+                    break
+
+                connection.executemany("""
+                    INSERT INTO files (path, modified_time, size, device, inode, partial_hash, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (path) DO UPDATE SET
+                        modified_time = excluded.modified_time,
+                        size = excluded.size,
+                        device = excluded.device,
+                        inode = excluded.inode,
+                        partial_hash = excluded.partial_hash,
+                        last_seen = excluded.last_seen
+                    """, ((path, record.mtime, record.size, record.device, record.inode, record.partial, record.last_seen) for path, record in batch))
+
+                # A modified file loses its old digests, so they're replaced rather than upserted
+                connection.executemany("DELETE FROM digests WHERE path = ?", ((path,) for path, _ in batch))
+                connection.executemany("INSERT INTO digests (path, algorithm, digest) VALUES (?, ?, ?)",
+                    ((path, key, value) for path, record in batch for key, value in [*zip(record.digests[::2], record.digests[1::2]), *record.extra]))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class ShardedCacheBackend:
+    """Splits the cache into JSON shards per directory subtree, next to a small index file.
+
+    A file belongs to the shard of its directory cut off after shard_depth path components, so a
+    library is split into one shard per subtree at that depth. Loading only reads the index (metadata
+    and the shard list), the shards under the scanned paths are read on demand through load_under, and
+    a write only rewrites the shards that have changed records. When shard_depth differs from the depth
+    the cache was written with, every shard is read on load and the next write rewrites them all."""
+    lazy = True
+
+    def __init__(self, file_path: str, shard_depth: int = 5):
+        self.file_path = file_path # A directory
+        self.index_path = os.path.join(file_path, "index.json")
+        self.shard_depth = shard_depth
+        self.shards = {} # Shard prefix to shard file name
+        self.loaded = set() # Prefixes of the shards read so far
+        self.regroup = False # Shards were written with another depth
+        self._prefixes = {} # Directory to shard prefix, directories repeat a lot
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as file:
+                index = json.load(file)
+        except json.JSONDecodeError as e:
+            raise CacheError(f"invalid shard index: {e}")
+
+        self.shards = index.get("shards", {})
+        self.loaded = set()
+        self.regroup = index.get("shard_depth", self.shard_depth) != self.shard_depth
+
+        if not self.regroup:
+            return index.get("metadata"), [], {}
+
+        # Changed records would land in shards of the new depth while the old shards keep their stale copies
+        print(f"\nCache shard depth changed from {index['shard_depth']} to {self.shard_depth}, rewriting every shard.")
+        records, directories, _ = self.load_under()
+        return index.get("metadata"), records, directories
+
+    def load_under(self, roots = None):
+        """Reads the shards not loaded yet that can hold files under the roots (every shard if roots is None).
+        Returns the records, the directories and the number of shards read."""
+        records = []
+        directories = {}
+        prefixes = [prefix for prefix in self.shards if prefix not in self.loaded and (roots is None or any(self._overlaps(prefix, root) for root in roots))]
+
+        for prefix in prefixes:
+            self.loaded.add(prefix)
+
+            try:
+                shard_records, shard_directories = self._read_shard(prefix)
+                records.extend(shard_records)
+                directories.update(shard_directories)
+            except (OSError, ValueError, KeyError, TypeError) as e: # Only this shard is lost, its files are hashed again
+                print(f"\nCache shard \"{self.shards[prefix]}\" is unreadable ({e}), it will be rebuilt.")
+
+        return records, directories, len(prefixes)
+
+    def write(self, metadata, records, changed=None, removed=None, directories=None, changed_directories=None):
+        # Directories are stored in the shard their own path falls in, so they're loaded together with their files
+        os.makedirs(self.file_path, exist_ok = True)
+        directories = directories or {}
+        by_shard = {}
+        directories_by_shard = {}
+
+        for record in records:
+            by_shard.setdefault(self._prefix(record.directory), []).append(record)
+
+        for path, directory in directories.items():
+            directories_by_shard.setdefault(self._prefix(path), {})[path] = directory
+
+        if changed is None or self.regroup: # Full write, shards without records are dropped
+            dirty = set(by_shard) | set(directories_by_shard) | set(self.shards)
+        else:
+            dirty = {self._prefix(record.directory) for record in changed} | {self._prefix(os.path.dirname(path)) for path in removed}
+            dirty |= {self._prefix(path) for path in changed_directories or ()}
+
+        for prefix in dirty:
+            shard_records = by_shard.get(prefix, [])
+            shard_directories = directories_by_shard.get(prefix, {})
+
+            if prefix in self.shards and prefix not in self.loaded and changed is not None:
+                # Changed without being loaded (a file added outside the loaded paths), the rest of the shard is kept
+                known = {record.path for record in shard_records} | set(removed)
+                stored_records, stored_directories = self._read_shard(prefix)
+                shard_records += [record for record in stored_records if record.path not in known]
+                shard_directories = {**stored_directories, **shard_directories}
+
+            if shard_records or shard_directories:
+                self.shards.setdefault(prefix, hashlib.blake2b(prefix.encode("utf-8", "surrogateescape"), digest_size = 8).hexdigest() + ".json")
+                self._write_shard(prefix, shard_records, shard_directories)
+            elif prefix in self.shards:
+                os.remove(os.path.join(self.file_path, self.shards.pop(prefix)))
+
+            self.loaded.add(prefix)
+
+        self.regroup = False
+        _write_atomic(self.index_path, {"metadata": metadata, "shard_depth": self.shard_depth, "shards": self.shards})
+
+    def close(self):
+        pass
+
+    def _read_shard(self, prefix):
+        with open(os.path.join(self.file_path, self.shards[prefix]), "r") as file:
+            shard = json.load(file)
+
+        records = []
+
+        # Rows are [name, mtime, size, device, inode, last seen, partial hash, [algorithm, digest, ...], [[key, value], ...]]
+        for directory, rows in shard["directories"].items():
+            for name, mtime, size, device, inode, last_seen, partial, digests, extra in rows:
+                record = FileRecord(os.path.join(directory, name), mtime)
+                record.size = size
+                record.device = _DEVICES.setdefault(device, device)
+                record.inode = inode
+                record.last_seen = last_seen
+                record.partial = bytes.fromhex(partial) if partial is not None else None
+                record.digests = tuple(bytes.fromhex(value) if i % 2 else value for i, value in enumerate(digests))
+                record.extra = tuple(tuple(pair) for pair in extra)
+                records.append(record)
+
+        directories = {path: (mtime, entries, tuple(subdirectories)) for path, (mtime, entries, subdirectories) in shard.get("scanned_directories", {}).items()}
+        return records, directories
+
+    def _write_shard(self, prefix, records, scanned_directories):
+        directories = {}
+
+        for record in records:
+            directories.setdefault(record.directory, []).append([
+                record.name, record.mtime, record.size, record.device, record.inode, record.last_seen,
+                record.partial.hex() if record.partial is not None else None,
+                [value.hex() if i % 2 else value for i, value in enumerate(record.digests)],
+                record.extra
+            ])
+
+        _write_atomic(os.path.join(self.file_path, self.shards[prefix]), {"prefix": prefix, "directories": directories, "scanned_directories": scanned_directories})
+
+    def _prefix(self, directory):
+        prefix = self._prefixes.get(directory)
+
+        if prefix is None:
+            drive, rest = os.path.splitdrive(directory)
+            parts = [part for part in rest.split(os.sep) if part]
+            prefix = self._prefixes[directory] = drive + os.sep + os.sep.join(parts[:self.shard_depth])
+
+        return prefix
+
+    def _overlaps(self, prefix, root):
+        # The shard lies under the root, or the root lies inside the shard's subtree
+        prefix = os.path.join(prefix, "")
+        root = os.path.join(os.path.abspath(root), "")
+        return prefix.startswith(root) or root.startswith(prefix)
+
+
+def _write_atomic(file_path, content):
+    temp_path = file_path + ".tmp"
+
+    with open(temp_path, "w") as file:
+        json.dump(content, file, separators = (",", ":"))
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(temp_path, file_path)
+
+
+CACHE_BACKENDS = {
+    "json": JsonCacheBackend,
+    "sqlite": SQLiteCacheBackend,
+    "sharded": ShardedCacheBackend
+}
 
 
 class CacheOperations:
     """Manages a cache system for storing and retrieving data efficiently.
 
     This class provides functionalities to load data from a cache file, write updates to the cache,
-    and clear the cache contents. It supports custom metadata for enhanced cache management. """
-    def __init__(self, metadata_keys: Optional[List[str]] = None,  file_path: Optional[str] = "./cache.json"):
+    and clear the cache contents. It supports custom metadata for enhanced cache management. Records are
+    FileRecords indexed by directory and filename for constant time lookups, and can be pruned or evicted
+    by usage and age. Storage is handled by a pluggable backend ("json", "sqlite" or "sharded"), an existing
+    JSON cache is migrated once when switching to another backend. The sharded backend only loads records
+    through ensure_loaded."""
+    def __init__(self, metadata_keys: Optional[List[str]] = None,  file_path: Optional[str] = "./cache.json", backend: Optional[str] = "json", stats: Optional[ScanStats] = None, **backend_options):
+        if backend not in CACHE_BACKENDS:
+            raise CacheError(f"Unknown cache backend ('{backend}'), choose one of {list(CACHE_BACKENDS)}.")
+
         self.cache_path = file_path
+        self.stats = stats or ScanStats()
+        self.backend = CACHE_BACKENDS[backend](file_path, **backend_options)
         self.default_metadata = {
             "time_created": self._current_time(),
             "time_updated": None,
@@ -19,60 +608,264 @@ class CacheOperations:
             for key in metadata_keys:
                 self.default_metadata[key] = ""
 
-        self.data = {}
+        self.index = {} # Directory to {filename: record}
+        self.directories = {} # Scanned directory to (mtime, entry count, subdirectories), for incremental rescans
         self.metadata = self.default_metadata.copy()
+        self._changed = {} # Records added or updated since the last write, keyed by path
+        self._removed = set()
+        self._changed_directories = set()
+        self._full_write = True # Next write has to rewrite everything (new, cleared or regenerated cache)
 
     def __str__(self):
-        return f"CacheOperations object with {len(self.data)} items in cache at {self.cache_path}"
-    
+        return f"CacheOperations object with {len(self)} items in cache at {self.cache_path}"
+
+    def __len__(self):
+        return sum(len(names) for names in self.index.values())
+
     def _current_time(self):
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     def load(self):
-        try: 
-            with open(self.cache_path, "r") as file:
-                cache_content = json.load(file)
+        with self.stats.phase("cache_load"):
+            self._load()
+
+        self.stats.count("cache_records_loaded", sum(len(names) for names in self.index.values()))
+
+    def _load(self):
+        try:
+            if not self.backend.exists() and self._migrate():
+                return
+
+            metadata, records, directories = self.backend.load()
+
+            bad_keys = [] # Checks if metadata keys exist in existing cache
+            for key in self.metadata.keys():
+                if key not in metadata:
+                    bad_keys.append(key)
+
+            if bad_keys:
+                raise KeyError(bad_keys)
+
+            self.metadata = metadata
+            self.metadata["times_loaded"] += 1 # Write this to cache immediately or after?
+            self._full_write = False
+            self._build_index(records)
+            self.directories = directories
 
-                bad_keys = [] # Checks if metadata keys exist in existing cache
-                for key in self.metadata.keys():
-                    if key not in cache_content.get("metadata"):
-                        bad_keys.append(key)
-                
-                if bad_keys: 
-                    raise KeyError(bad_keys)
-
-                self.metadata = cache_content.get("metadata")
-                self.data = cache_content.get("data")
-                self.metadata["times_loaded"] += 1 # Write this to cache immediately or after?
-                
         except FileNotFoundError:
             print("\nCache file not found. Initializing a new cache.")
             self.write()
 
-        except json.JSONDecodeError:
-            print("\nCache file is corrupt (invalid JSON). Regenerating cache.")
+        except CacheError as e:
+            print(f"\nCache file is corrupt ({e}). Regenerating cache.")
             self.write()
-        
+
         except KeyError as e:
             print(f"\nInconsistent metadata key(s) {e} passed. Regenerating cache with keys.")
             self.write()
 
+    def ensure_loaded(self, roots = None):
+        """Loads the records under the roots (everything if roots is None) for backends that load on demand,
+        other backends have everything loaded already."""
+        if not getattr(self.backend, "lazy", False):
+            return
+
+        with self.stats.phase("cache_load"):
+            records, directories, shards = self.backend.load_under(roots)
+
+            for record in records:
+                self._stamp_unseen(record)
+                self.index.setdefault(record.directory, {})[record.name] = record
+
+            self.directories.update(directories)
+
+        self.stats.count("cache_shards_loaded", shards)
+        self.stats.count("cache_records_loaded", len(records))
+
+    def _migrate(self):
+        # Imports an old cache.json next to the database, only done once since the JSON file is renamed afterwards.
+        if isinstance(self.backend, JsonCacheBackend):
+            return False
+
+        json_backend = JsonCacheBackend(os.path.join(os.path.dirname(os.path.normpath(self.cache_path)), "cache.json"))
+
+        if not json_backend.exists():
+            return False
+
+        try:
+            metadata, records, directories = json_backend.load()
+        except CacheError:
+            return False
+
+        self.metadata.update(metadata or {})
+        self._build_index(records)
+        self.directories = directories
+        self.write()
+        os.replace(json_backend.file_path, json_backend.file_path + ".migrated")
+        print(f"\nMigrated cache from \"{json_backend.file_path}\" to \"{self.cache_path}\".")
+        return True
+
     def write(self):
+        with self.stats.phase("cache_write"):
+            self._write()
+
+    def _write(self):
         self.metadata["time_updated"] = self._current_time()
-        cache_structure = {
-            "metadata": self.metadata,
-            "data": self.data
-            }
+
         try:
-            with open(self.cache_path, "w") as file:
-                json.dump(cache_structure, file, indent = 4)
+            if self._full_write:
+                records = list(self.records())
+                self.stats.count("cache_records_written", len(records))
+                self.backend.write(self.metadata, records, directories = self.directories)
+            else:
+                self.stats.count("cache_records_written", len(self._changed))
+                self.backend.write(self.metadata, self.records(), list(self._changed.values()), self._removed, self.directories, self._changed_directories)
+
+            self._changed = {}
+            self._removed = set()
+            self._changed_directories = set()
+            self._full_write = False
 
         except Exception as e:
             print(f"\nCould not write cache due to the following exception: {e}")
-    
+
     def clear(self):
         self.metadata = self.default_metadata.copy()
-        self.data = {}
+        self.index = {}
+        self.directories = {}
+        self._full_write = True
         self.write()
         print("\nCache cleared.")
 
+    def get(self, path):
+        """Returns the record for a path, or None if the path isn't cached."""
+        directory, name = os.path.split(path)
+        names = self.index.get(directory)
+        return names.get(name) if names is not None else None
+
+    def records(self):
+        for names in self.index.values():
+            yield from names.values()
+
+    def add(self, record):
+        """Adds a file record (a FileRecord or a dict with the same keys), replacing any earlier record
+        with the same path. Returns the stored record."""
+        if not isinstance(record, FileRecord):
+            record = FileRecord.from_dict(record)
+
+        record.last_seen = self.metadata["times_loaded"]
+        self.index.setdefault(record.directory, {})[record.name] = record
+        self.updated(record)
+        return record
+
+    def remove(self, record):
+        names = self.index[record.directory]
+        del names[record.name]
+
+        if not names:
+            del self.index[record.directory]
+
+        path = record.path
+        self._changed.pop(path, None)
+        self._removed.add(path)
+
+    def remove_where(self, predicate):
+        """Removes every record matching the predicate in a single pass. Returns the number of removed records."""
+        removed = [record for record in self.records() if predicate(record)]
+
+        for record in removed:
+            self.remove(record)
+
+        return len(removed)
+
+    def updated(self, record):
+        """Marks a record as changed so the backend writes it on the next write."""
+        path = record.path
+        self._changed[path] = record
+        self._removed.discard(path)
+
+    def touch(self, record, max_unused_loads):
+        """Marks a record as seen in the current load.
+
+        The record is only rewritten once it's halfway to being evicted, so an unchanged file isn't
+        written back to the cache on every scan."""
+        if self.metadata["times_loaded"] - (record.last_seen or 0) >= max(1, max_unused_loads // 2):
+            record.last_seen = self.metadata["times_loaded"]
+            self.updated(record)
+
+    def records_under(self, roots, recursive):
+        """Yields the records a scan of the roots would cover."""
+        roots = [os.path.join(root, "") for root in roots]
+
+        # Checked once per directory rather than once per file
+        for directory, names in self.index.items():
+            directory = os.path.join(directory, "")
+
+            if directory in roots or (recursive and any(directory.startswith(root) for root in roots)):
+                yield from names.values()
+
+    def prune(self, roots, seen_paths, recursive, unlisted = ()):
+        """Removes records under the scanned roots whose files weren't seen in the scan (deleted, moved or excluded).
+        Records in the unlisted directories (and under them in a recursive scan) are kept, their files weren't looked at."""
+        unlisted = [os.path.join(path, "") for path in unlisted]
+        stale = [record for record in self.records_under(roots, recursive) if record.path not in seen_paths
+                 and not self._under(record.directory, unlisted, recursive)]
+
+        for record in stale:
+            self.remove(record)
+
+        return len(stale)
+
+    def set_directory(self, path, mtime, entries, subdirectories):
+        """Records a listed directory, an mtime of None keeps it from being skipped on the next scan."""
+        directory = (mtime, entries, tuple(subdirectories))
+
+        if self.directories.get(path) != directory:
+            self.directories[path] = directory
+            self._changed_directories.add(path)
+
+    def prune_directories(self, roots, seen_directories, recursive, unlisted = ()):
+        """Removes directories under the scanned roots that weren't seen in the scan, except the unlisted ones (see prune)."""
+        roots = [os.path.join(root, "") for root in roots]
+        unlisted = [os.path.join(path, "") for path in unlisted]
+        stale = [path for path in self.directories if path not in seen_directories
+                 and self._under(path, roots, recursive) and not self._under(path, unlisted, recursive)]
+
+        for path in stale:
+            del self.directories[path]
+            self._changed_directories.add(path)
+
+        return len(stale)
+
+    def _under(self, directory, prefixes, recursive):
+        # Prefixes end with a separator, a directory is only under itself in a non-recursive scan
+        directory = os.path.join(directory, "")
+        return directory in prefixes or (recursive and any(directory.startswith(prefix) for prefix in prefixes))
+
+    def evict(self, max_unused_loads = 0, max_age_days = 0):
+        """Evicts records not seen within the last max_unused_loads loads, and clears the whole cache
+        once it's older than max_age_days. A value of 0 disables either check."""
+        if max_age_days and self.metadata.get("time_created"):
+            created = datetime.strptime(self.metadata["time_created"], "%Y-%m-%d %H:%M:%S")
+
+            if (datetime.now() - created).days >= max_age_days:
+                print(f"\nCache is older than {max_age_days} day(s), rebuilding.")
+                self.clear()
+                return
+
+        if max_unused_loads:
+            times_loaded = self.metadata["times_loaded"]
+            return self.remove_where(lambda record: times_loaded - (record.last_seen or 0) > max_unused_loads)
+
+    def _build_index(self, records):
+        self.index = {}
+
+        for record in records:
+            self._stamp_unseen(record)
+            self.index.setdefault(record.directory, {})[record.name] = record
+
+    def _stamp_unseen(self, record):
+        # Caches from before records had a last seen load count them as seen now, rather than as seen in load 0 and evicted
+        if record.last_seen is None:
+            record.last_seen = self.metadata["times_loaded"]
+            self.updated(record)
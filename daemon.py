@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import threading
+import socketserver
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from file_operations import FileOperations
+from hashing import calculate_hash
+from report import REPORT_PATH
+
+DAEMON_PORT = 8765
+FIELD_KINDS = {int: "an integer", str: "a string", bool: "true or false", list: "a list"} # For error messages
+GET_OPS = ("status", "report", "lookup") # Read only, lookups only by size and digest
+
+
+class ServiceError(Exception):
+    """Exceptions raised for requests the service can't answer, sent back to the client as an error."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class ScanService:
+    """Keeps the cache loaded between requests so queries don't pay for a cold start.
+
+    Requests are JSON objects with an "op" key, answered by handle with a JSON object. Lookups only read
+    the (size) index of the last scan and run in parallel, scans and anything that changes the cache take
+    the lock, so one rescan runs at a time while lookups of already hashed files keep being answered."""
+    def __init__(self, settings):
+        self.fo = FileOperations(settings)
+        self.fo.cache.ensure_loaded() # Lookups need every record, not only the ones under a scan path
+        self.lock = threading.Lock()
+        self.sizes = {}
+        self._build_index()
+
+    def handle(self, request):
+        handlers = {
+            "lookup": self.lookup,
+            "rescan": self.rescan,
+            "report": self.report,
+            "status": self.status
+        }
+        handler = handlers.get(request.get("op"))
+
+        if handler is None:
+            raise ServiceError(f"Unknown op ('{request.get('op')}'), choose one of {list(handlers)}.")
+
+        return handler(request)
+
+    def lookup(self, request):
+        """Finds cached files with the same content as "path", or as a file of "size" and "digest".
+
+        Only files of the same size are candidates, so a file of a size nobody has isn't read at all.
+        Candidates without a full digest (their size was unique when scanned) are hashed and cached."""
+        algorithm = self.fo.settings["hash_algorithm"]
+        path = field(request, "path", str)
+        size = field(request, "size", int)
+        digest = field(request, "digest", str)
+
+        if path is not None:
+            path = os.path.abspath(path)
+
+            try:
+                size = os.stat(path).st_size
+            except OSError as error:
+                raise ServiceError(str(error))
+
+        if size is None or (path is None and digest is None):
+            raise ServiceError("A lookup needs a \"path\", or a \"size\" and a \"digest\".")
+
+        candidates = [record for record in self.sizes.get(size, ()) if record.path != path]
+
+        if not candidates:
+            return {"duplicate": False, "matches": []}
+
+        if digest is None:
+            try:
+                digest = calculate_hash(path, size, algorithm, self.fo.settings.get("hash_chunk_size", 0))
+            except OSError as error:
+                raise ServiceError(str(error))
+
+        if any(algorithm not in record for record in candidates):
+            with self.lock:
+                self._hash_records([record for record in candidates if algorithm not in record], algorithm)
+
+        matches = sorted(record.path for record in candidates if record.get(algorithm) == digest)
+        return {"duplicate": bool(matches), "digest": digest, "matches": matches}
+
+    def rescan(self, request):
+        paths = field(request, "paths", list)
+        recursive = field(request, "recursive", bool, True)
+
+        if not paths or not all(isinstance(path, str) for path in paths):
+            raise ServiceError("A rescan needs a list of \"paths\".")
+
+        paths = [os.path.abspath(path) for path in paths]
+        missing = [path for path in paths if not os.path.isdir(path)]
+
+        if missing:
+            raise ServiceError(f"Not a directory: {missing}")
+
+        with self.lock:
+            self.fo.error_dump = []
+            self.fo.scan_directory(paths, recursive)
+            self._build_index()
+            errors = self.fo.error_dump
+
+        return {"stats": self.fo.last_stats.counters, "errors": errors, **self._read_report(0)}
+
+    def report(self, request):
+        # The report is replaced in one rename, so it can be read while a rescan writes a new one
+        return self._read_report(max(0, field(request, "limit", int, 100)))
+
+    def status(self, request):
+        return {
+            "records": len(self.fo.cache),
+            "sizes": len(self.sizes),
+            "scanning": self.lock.locked(),
+            "algorithm": self.fo.settings["hash_algorithm"]
+        }
+
+    def close(self):
+        with self.lock: # Digests added by lookups since the last scan
+            self.fo.cache.write()
+
+    def _hash_records(self, records, algorithm):
+        for record in records:
+            if algorithm in record: # Hashed by another lookup while this one waited for the lock
+                continue
+
+            try:
+                stat = os.stat(record.path)
+
+                if stat.st_size != record["SIZE"] or stat.st_mtime != record["MODIFIED_TIME"]: # Changed since the last scan, a rescan picks it up
+                    continue
+
+                record[algorithm] = calculate_hash(record.path, record["SIZE"], algorithm, self.fo.settings.get("hash_chunk_size", 0))
+                self.fo.cache.updated(record)
+            except OSError:
+                continue
+
+    def _build_index(self):
+        # Rebuilt and swapped in whole, so lookups running meanwhile keep using the previous one
+        sizes = {}
+
+        for record in self.fo.cache.records():
+            if record.get("SIZE") is not None:
+                sizes.setdefault(record["SIZE"], []).append(record)
+
+        self.sizes = sizes
+
+    def _read_report(self, limit):
+        try:
+            with open(REPORT_PATH, "r") as file:
+                summary = json.loads(file.readline())
+                groups = []
+
+                for line in file:
+                    if len(groups) >= limit:
+                        break
+
+                    groups.append(json.loads(line))
+
+        except (OSError, json.JSONDecodeError):
+            return {"summary": None, "groups": []}
+
+        return {"summary": summary, "groups": groups}
+
+
+def field(request, key, kind, default = None):
+    """Returns a request field, raising ServiceError when it's there but not of the kind (bools don't pass as ints)."""
+    value = request.get(key, default)
+
+    if value is not None and (not isinstance(value, kind) or (kind is int and isinstance(value, bool))):
+        raise ServiceError(f"\"{key}\" has to be {FIELD_KINDS[kind]}.")
+
+    return value
+
+
+def respond(service, request):
+    try:
+        if not isinstance(request, dict):
+            raise ServiceError("Requests are JSON objects.")
+
+        return {"ok": True, **service.handle(request)}
+    except ServiceError as error:
+        return {"ok": False, "error": str(error)}
+    except (OSError, ValueError, TypeError) as error: # Anything else a request can trigger, the connection stays usable
+        return {"ok": False, "error": f"Request failed ({error!r})."}
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """POST /<op> with a JSON body (Content-Type: application/json), or GET /<op>?key=value for status,
+    report and lookups by size and digest.
+
+    Any web page can make the browser send a GET, or a POST of a form, to 127.0.0.1. So GET only answers
+    requests that read, only a JSON POST (which browsers don't send cross origin without asking first)
+    can start a rescan or read a file by path, and requests from a page (with an Origin header) are refused."""
+    service = None
+
+    def do_GET(self):
+        if self._from_page():
+            return
+
+        url = urlparse(self.path)
+        request = {key: self._query_value(values[-1]) for key, values in parse_qs(url.query).items()}
+        op = url.path.strip("/")
+
+        if op not in GET_OPS or (op == "lookup" and "path" in request):
+            self._send_json(405, {"ok": False, "error": f"Use POST with a JSON body for this request, GET only answers {list(GET_OPS)} (lookups by \"size\" and \"digest\")."})
+            return
+
+        self._send({**request, "op": op})
+
+    def _query_value(self, value):
+        # Numbers and true/false are JSON, anything else is taken as a string
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return value
+
+    def do_POST(self):
+        if self._from_page():
+            return
+
+        if self.headers.get_content_type() != "application/json":
+            self._send_json(415, {"ok": False, "error": "POST requests need \"Content-Type: application/json\"."})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except json.JSONDecodeError as error:
+            self._send_json(400, {"ok": False, "error": f"Invalid JSON ({error})."})
+            return
+
+        if isinstance(request, dict):
+            request["op"] = self.path.strip("/") or request.get("op")
+
+        self._send(request)
+
+    def _from_page(self):
+        if self.headers.get("Origin") is None:
+            return False
+
+        self._send_json(403, {"ok": False, "error": "Requests from web pages aren't accepted."})
+        return True
+
+    def _send(self, request):
+        response = respond(self.service, request)
+        self._send_json(200 if response["ok"] else 400, response)
+
+    def _send_json(self, status, response):
+        body = json.dumps(response).encode("utf-8", "surrogateescape")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Automation can send thousands of requests a day
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line, each answered with one JSON line. A connection can send any number of them."""
+    service = None
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as error:
+                response = {"ok": False, "error": f"Invalid JSON ({error})."}
+            else:
+                response = respond(self.service, request)
+
+            self.wfile.write(json.dumps(response).encode("utf-8", "surrogateescape") + b"\n")
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Keeps the cache in memory and answers duplicate lookups, rescans and report queries.")
+    parser.add_argument("--port", type = int, help = "Port on 127.0.0.1 to serve HTTP on, defaults to \"daemon_port\"")
+    parser.add_argument("--socket", help = "Serve on a Unix socket at this path instead of HTTP")
+    args = parser.parse_args()
+
+    if args.socket and not hasattr(socket, "AF_UNIX"):
+        print("Unix sockets aren't supported on this platform, use --port.")
+        sys.exit(1)
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"), "r") as file:
+        settings = json.load(file)
+
+    service = ScanService(settings)
+
+    if args.socket:
+        if os.path.exists(args.socket): # Left behind by a daemon that didn't shut down cleanly
+            os.remove(args.socket)
+
+        SocketHandler.service = service
+        server = UnixServer(args.socket, SocketHandler)
+        os.chmod(args.socket, 0o600) # Only the owner can query or start rescans
+        address = args.socket
+    else:
+        HTTPHandler.service = service
+        server = ThreadingHTTPServer(("127.0.0.1", args.port or settings.get("daemon_port", DAEMON_PORT)), HTTPHandler)
+        server.daemon_threads = True
+        address = f"http://127.0.0.1:{server.server_address[1]}"
+
+    print(f"Serving {len(service.fo.cache)} cached files on {address}, Ctrl+C to stop.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
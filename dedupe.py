@@ -0,0 +1,157 @@
+import os
+import json
+import shutil
+import filecmp
+from report import REPORT_PATH
+
+try: # Reflinks need ioctl, which isn't available on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+UNDO_PATH = "./dedupe_undo.ndjson"
+FICLONE = 0x40049409 # From linux/fs.h, supported by Btrfs, XFS and bcachefs
+
+
+class Deduplicator:
+    """Replaces confirmed duplicates from the report with hardlinks (or reflinks) to a single copy.
+
+    The oldest file of every group is kept. Before a file is replaced its size and content are compared
+    against the kept copy again, since the report can be out of date. The link is created next to the
+    file and renamed over it, so the path always points to either the old or the new file. Everything
+    needed to separate the files again is appended to the undo log before the swap."""
+    def __init__(self, mode = "hardlink", undo_path = UNDO_PATH):
+        if mode == "reflink" and fcntl is None:
+            raise ValueError("Reflinks aren't supported on this platform.")
+
+        self.mode = mode
+        self.undo_path = undo_path
+        self.error_dump = []
+        self.linked = 0
+        self.bytes_freed = 0
+
+    def deduplicate(self, report_path = REPORT_PATH):
+        with open(report_path, "r") as report, open(self.undo_path, "a") as undo_log:
+            for line in report:
+                group = json.loads(line)
+
+                if group["type"] == "group":
+                    self._link_group([file["path"] for file in group["files"]], undo_log)
+                elif group["type"] == "directory":
+                    for paths in self._directory_files(group["directories"]):
+                        self._link_group(paths, undo_log)
+
+        return self.linked, self.bytes_freed
+
+    def undo(self):
+        """Gives every linked file its own copy of the content back and restores its metadata."""
+        restored = 0
+
+        with open(self.undo_path, "r") as undo_log:
+            entries = [json.loads(line) for line in undo_log]
+
+        for entry in reversed(entries):
+            try:
+                self._separate(entry)
+                restored += 1
+            except OSError as error:
+                self.error_dump.append(f"Could not restore \"{entry['path']}\" ({error}).")
+
+        os.replace(self.undo_path, self.undo_path + ".undone") # Kept around, but not applied twice
+        return restored
+
+    def _link_group(self, paths, undo_log):
+        existing = []
+
+        for path in paths:
+            try:
+                existing.append((os.stat(path), path))
+            except OSError as error:
+                self.error_dump.append(f"Skipped \"{path}\" ({error}).")
+
+        if len(existing) < 2:
+            return
+
+        existing.sort(key = lambda item: (item[0].st_mtime_ns, item[1])) # Oldest file is kept
+        source_stat, source = existing[0]
+
+        for target_stat, target in existing[1:]:
+            if (target_stat.st_dev, target_stat.st_ino) == (source_stat.st_dev, source_stat.st_ino):
+                continue # Already the same file
+
+            if target_stat.st_dev != source_stat.st_dev:
+                self.error_dump.append(f"Skipped \"{target}\", it's on a different filesystem than \"{source}\".")
+                continue
+
+            try:
+                if target_stat.st_size != source_stat.st_size or not filecmp.cmp(source, target, shallow = False):
+                    self.error_dump.append(f"Skipped \"{target}\", it no longer matches \"{source}\".")
+                    continue
+
+                self._log(undo_log, source, target, target_stat)
+                self._replace(source, target, target_stat)
+                self.linked += 1
+                self.bytes_freed += target_stat.st_size
+
+            except OSError as error:
+                self.error_dump.append(f"Could not link \"{target}\" ({error}).")
+
+    def _replace(self, source, target, target_stat):
+        temp_path = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.dedupe")
+
+        try:
+            if self.mode == "reflink":
+                with open(source, "rb") as source_file, open(temp_path, "wb") as temp_file:
+                    fcntl.ioctl(temp_file.fileno(), FICLONE, source_file.fileno())
+
+                shutil.copystat(target, temp_path) # A reflink is a file of its own, so it keeps the target's metadata
+            else:
+                os.link(source, temp_path)
+
+            os.replace(temp_path, target)
+
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _log(self, undo_log, source, target, target_stat):
+        undo_log.write(json.dumps({
+            "path": target,
+            "source": source,
+            "link": self.mode,
+            "mode": target_stat.st_mode,
+            "uid": target_stat.st_uid,
+            "gid": target_stat.st_gid,
+            "atime_ns": target_stat.st_atime_ns,
+            "mtime_ns": target_stat.st_mtime_ns
+        }) + "\n")
+
+        # On disk before the file is touched, otherwise a crash could leave a link nobody knows about
+        undo_log.flush()
+        os.fsync(undo_log.fileno())
+
+    def _separate(self, entry):
+        path = entry["path"]
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.undo")
+        shutil.copyfile(path, temp_path) # Read through the link, so the copy gets its own data
+
+        os.chmod(temp_path, entry["mode"])
+        if hasattr(os, "chown"):
+            try:
+                os.chown(temp_path, entry["uid"], entry["gid"])
+            except PermissionError: # Only root can give files away
+                pass
+        os.utime(temp_path, ns = (entry["atime_ns"], entry["mtime_ns"]))
+
+        os.replace(temp_path, path)
+
+    def _directory_files(self, directories):
+        # Identical trees have the same relative paths, so the files are grouped by those
+        relative_paths = []
+
+        for directory, _, names in os.walk(directories[0]):
+            relative_paths.extend(os.path.relpath(os.path.join(directory, name), directories[0]) for name in names)
+
+        for relative_path in sorted(relative_paths):
+            yield [os.path.join(directory, relative_path) for directory in directories]
@@ -0,0 +1,102 @@
+import os
+from hashing import new_hash
+
+
+def find_duplicate_directories(records, roots, algorithm):
+    """Finds identical directory trees under the roots from the cached file digests, nothing is read from disk.
+
+    Directories are hashed bottom-up in a single pass, a directory's hash covers the names and digests of
+    its files and the names and hashes of its subdirectories (a Merkle tree). A directory containing a
+    file without a full digest is unique, since size tiering only skips files that have no duplicate,
+    and so is every directory above it. Only the topmost directory of nested duplicates is reported.
+    Excluded files and empty directories aren't cached, so they don't affect the comparison.
+
+    Returns (digest, total size, file count, directory paths) groups."""
+    roots = [os.path.normpath(root) for root in roots]
+    root_prefixes = [os.path.join(root, "") for root in roots]
+    children = {} # Directory to (kind, name, digest or None, size, file count) entries
+
+    for record in records:
+        path = record["PATH"]
+
+        if not any(path.startswith(prefix) for prefix in root_prefixes):
+            continue
+
+        directory, name = os.path.split(path)
+        children.setdefault(directory, []).append(("f", name, record.get(algorithm), record.get("SIZE", 0), 1))
+
+    # Parents are registered up to the root so directories without files of their own still get a hash
+    for directory in list(children):
+        while directory not in roots:
+            parent = os.path.dirname(directory)
+
+            if parent == directory or not any(parent == root or parent.startswith(prefix) for root, prefix in zip(roots, root_prefixes)):
+                break
+
+            children.setdefault(parent, [])
+            directory = parent
+
+    hashes = {} # Directory to (digest, size, file count), digest is None for unique directories
+
+    # Deepest first, so every subdirectory is done before its parent
+    for directory in sorted(children, key = lambda directory: directory.count(os.sep), reverse = True):
+        entries = children[directory]
+        size = sum(entry[3] for entry in entries)
+        file_count = sum(entry[4] for entry in entries)
+        digest = None
+
+        if entries and all(entry[2] is not None for entry in entries):
+            hash_obj = new_hash(algorithm)
+
+            for kind, name, entry_digest, _, _ in sorted(entries):
+                hash_obj.update(f"{kind}\0{name}\0{entry_digest}\n".encode("utf-8", "surrogateescape"))
+
+            digest = hash_obj.hexdigest()
+
+        hashes[directory] = (digest, size, file_count)
+        parent = os.path.dirname(directory)
+
+        if directory not in roots and parent in children:
+            children[parent].append(("d", os.path.basename(directory), digest, size, file_count))
+
+    groups = {}
+
+    for directory, (digest, size, file_count) in hashes.items():
+        if digest is not None:
+            groups.setdefault(digest, []).append(directory)
+
+    duplicate_directories = {directory for directories in groups.values() if len(directories) > 1 for directory in directories}
+    duplicates = []
+
+    for digest, directories in groups.items():
+        # A group is covered when all of its directories sit inside duplicated parents, which are reported instead
+        if len(directories) > 1 and not all(os.path.dirname(directory) in duplicate_directories for directory in directories):
+            _, size, file_count = hashes[directories[0]]
+            duplicates.append((digest, size, file_count, sorted(directories)))
+
+    return duplicates
+
+
+def enclosing_directories(path, directory_index):
+    """Yields the directories above the path that belong to a directory group, innermost first. directory_index
+    maps directories to group indexes."""
+    directory = os.path.dirname(path)
+
+    while True:
+        if directory in directory_index:
+            yield directory
+
+        parent = os.path.dirname(directory)
+
+        if parent == directory:
+            return
+
+        directory = parent
+
+
+def covering_group(path, directory_index):
+    """Returns the index of the innermost directory group containing the path, or None."""
+    for directory in enclosing_directories(path, directory_index):
+        return directory_index[directory]
+
+    return None
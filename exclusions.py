@@ -0,0 +1,117 @@
+import os
+import re
+import fnmatch
+
+GLOB_CHARS = ("*", "?", "[")
+SETTINGS_KEYS = ("max_file_size_mb", "default_exts_skip", "user_exts_skip", "default_paths_skip", "user_paths_skip", "user_filenames_skip")
+
+
+class ExclusionMatcher:
+    """Exclusion rules from the settings, compiled once per scan.
+
+    Paths are resolved into a set and a prefix trie, extensions and filenames into sets, and any rule
+    containing glob characters into a single precompiled regex per kind. Rules without a path separator
+    are matched against the entry name, the others against the full path. The checks return the name
+    of the matching rule kind (or None), so skipped entries can be counted per rule."""
+    def __init__(self, settings):
+        self.max_size = settings["max_file_size_mb"] * 1024**2
+        self.skip_paths = set()
+        self.path_trie = {}
+        self.extensions = {ext.lower() for ext in settings["default_exts_skip"] + settings["user_exts_skip"]}
+        self.filenames = set()
+        path_globs = []
+        name_globs = []
+
+        for skip_path in settings["default_paths_skip"] + settings["user_paths_skip"]:
+            skip_path = os.path.expandvars(skip_path)
+
+            if any(char in skip_path for char in GLOB_CHARS):
+                if os.sep in skip_path or (os.altsep and os.altsep in skip_path):
+                    path_globs.append(os.path.normcase(skip_path))
+                else:
+                    name_globs.append(skip_path)
+                continue
+
+            resolved_path = self._normalize(skip_path)
+            self.skip_paths.add(resolved_path)
+            self._add_to_trie(resolved_path)
+
+        for filename in settings["user_filenames_skip"]:
+            if any(char in filename for char in GLOB_CHARS):
+                name_globs.append(filename)
+            else:
+                self.filenames.add(filename)
+
+        self.path_pattern = self._compile(path_globs)
+        self.name_pattern = self._compile(name_globs)
+
+    def skip_root(self, path):
+        """Checks a scan root, which is skipped if it or any of its parents is excluded."""
+        node = self.path_trie
+
+        for part in self._split(self._normalize(path)):
+            node = node.get(part)
+
+            if node is None:
+                return False
+
+            if None in node: # Terminal marker, an excluded path ends here
+                return True
+
+        return False
+
+    def skip_dir(self, path, name):
+        """Checks a directory before it's descended into, parents have already been checked by the walk."""
+        return self._skip_path(path) or self._skip_name(name)
+
+    def skip_file(self, path, name, size):
+        if size > self.max_size:
+            return "size"
+
+        return self._skip_path(path) or self._skip_name(name)
+
+    def _skip_path(self, path):
+        path = self._normalize(path)
+
+        if path in self.skip_paths:
+            return "path"
+
+        if self.path_pattern is not None and self.path_pattern.match(path) is not None:
+            return "path_pattern"
+
+        return None
+
+    def _skip_name(self, name):
+        # Extract file name and extension to check if it should be skipped.
+        name_no_ext, file_extension = os.path.splitext(name)
+
+        if name in self.filenames or name_no_ext in self.filenames:
+            return "filename"
+
+        if file_extension and file_extension.lower() in self.extensions:
+            return "extension"
+
+        if self.name_pattern is not None and self.name_pattern.match(name) is not None:
+            return "name_pattern"
+
+        return None
+
+    def _add_to_trie(self, path):
+        node = self.path_trie
+
+        for part in self._split(path):
+            node = node.setdefault(part, {})
+
+        node[None] = True
+
+    def _normalize(self, path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def _split(self, path):
+        return [part for part in path.split(os.sep) if part]
+
+    def _compile(self, patterns):
+        if not patterns:
+            return None
+
+        return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns))
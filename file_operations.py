@@ -1,8 +1,39 @@
 import os 
-import hashlib
 import json
+import time
+import queue
+import signal
+import threading
+import cProfile
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cache_manager as cm
-#import multiprocessing
+from exclusions import ExclusionMatcher, SETTINGS_KEYS
+from walker import DirectoryWalker, WalkEntry, inode_key
+from async_walker import AsyncDirectoryWalker
+from report import DuplicateReport, REPORT_PATH
+from stats import ScanStats, STATS_PATH, timed_call
+from progress import ProgressReporter
+from directories import find_duplicate_directories, covering_group, enclosing_directories
+from manifest import write_manifest
+from songs import find_song_folders, read_song_metadata, group_songs, SONG_INI, METADATA_KEY
+from hashing import calculate_hash, calculate_partial_hash, compare_files, available_algorithms, DIFFERS_KEY
+
+WORK_QUEUE_SIZE = 1024 # Max entries the walker can get ahead of the main thread
+RESUME_PATH = "./scan_resume.json"
+MTIME_GRANULARITY = 2 # Seconds, FAT and some network filesystems only store mtimes to the nearest 2 seconds
+CACHE_PATHS = {
+    "json": "./cache.json",
+    "sqlite": "./cache.db",
+    "sharded": "./cache_shards"
+}
+
+
+class ScanInterrupted(Exception):
+    """Raised when a scan is stopped by SIGINT or SIGTERM, after its progress has been checkpointed."""
+    def __init__(self, message):
+        super().__init__(message)
+
 
 # Using a class instead of utility functions to preserve state / multiple scans at once 
 class FileOperations:
@@ -12,137 +43,693 @@ class FileOperations:
         self.pbar = pbar
         self.error_dump = []
         self.detected = False
+        self.exclusions = None
+        self.progress = ProgressReporter() # Replaced at the start of each scan, once the progress bar is known
+        self.stats = ScanStats() # Replaced after every scan, the first one also holds the cache load
+        self.last_stats = None
+        self.song_folders = {} # Song folders of the last scan when song fingerprinting is on
+        self.profile = False # Wraps scans in cProfile, results end up in the stats file
+        self.paranoid = False # Lists every directory, even the ones that haven't changed since the last scan
+        self.interrupted = False # Set by the signal handler, acted on by the main thread at the next checkpoint check
+        self.completed_directories = {} # Directories fully indexed in the current scan, to their subdirectories
+        self.resume_state = None
+        self._last_checkpoint = 0
+        self._bytes_since_checkpoint = 0
         # Initializes cache object with custom metadata key for hash
-        self.cache = cm.CacheOperations(["hash_algorithm"])
+        backend = settings.get("cache_backend", "json")
+        backend_options = {"shard_depth": settings.get("cache_shard_depth", 5)} if backend == "sharded" else {}
+        self.cache = cm.CacheOperations(["hash_algorithm"], CACHE_PATHS[backend], backend, self.stats, **backend_options)
         self.cache.load()
         self.validate_hash_algo()
 
-    def scan_directory(self, scan_path, recursive=False, top_level=True):
-        for path in scan_path:
-            for entry in os.scandir(path):
+    def scan_directory(self, scan_path, recursive=False, resume=False):
+        """Scans the paths for duplicates. With resume, directories completed by the interrupted scan in
+        the resume file (see load_resume_state) aren't listed again. Raises ScanInterrupted on SIGINT or SIGTERM."""
+        # Only profiles the main thread, walking and hashing show up as time spent waiting on them
+        profiler = cProfile.Profile() if self.profile else None
+        previous_handlers = self._install_signal_handlers()
+
+        try:
+            with self.stats.phase("scan"):
+                if profiler is not None:
+                    profiler.enable()
+
                 try:
-                    filename = entry.name
-
-                    if self._omit(entry): # Resolve the path once instead of everytime in the function
-                        self._update_pbar(entry, True)
-                        continue
-
-                    in_cache = self._check_in_cache(entry) # Checks for an identical match
-
-                    if entry.is_file():
-                        self._update_pbar(entry, in_cache)
-
-                        if not in_cache:
-                            if filename not in self.cache.data: # Creates an empty list to hold a dictionary for each name instance, if no other instances exist.
-                                self.cache.data[filename] = [] 
-                            
-                            self.cache.data[filename].append({
-                                self.settings["hash_algorithm"]: self._calculate_hash(entry),
-                                "PATH": entry.path,
-                                "MODIFIED_TIME": entry.stat().st_mtime
-                            })
-                
-                    elif entry.is_dir() and recursive: # Calls function recusively to perform check on subdirecories if the recursive flag is True
-                        self.scan_directory([entry.path], True, False)
-
-                except (PermissionError, IOError) as error:
-                    self.error_dump.append(str(error)) # Make a logfile instead, maybe include cacheoperations
-                    continue
-        
-        if top_level:
-            self.cache.metadata["hash_algorithm"] = self.settings["hash_algorithm"]
-            self.cache.write() # Only write at top level to avoid corruption and to make sure a complete dataset is available.
-            self._identify_duplicates()
-
-    def _calculate_hash(self, file_entry):
-        algorithm = self.settings.get("hash_algorithm", "md5").lower()
-
-        hash_obj = getattr(hashlib, algorithm)()
-
-        with open(file_entry.path, "rb") as file: # Read files in binary to eliminate etc newline differences between OS's.
-            while True:
-                chunk = file.read(self.settings["hash_chunk_size"])
-
-                if not chunk:
-                    break
-
-                hash_obj.update(chunk) 
-  
-        return hash_obj.hexdigest() 
-
-    def _identify_duplicates(self): # Needs tweaking for multiple runs, and persistant detected duplicates.
-        duplicates = {}
-        hashes = {}
-
-        for _, name_instances in self.cache.data.items():
-            for instance in name_instances:
-                hash = instance[self.settings["hash_algorithm"]]
-                path = instance["PATH"]
-
-                if hash in hashes:
-                    if hash not in duplicates:
-                        duplicates[hash] = [hashes[hash]]
-
-                    duplicates[hash].append(path)
-                else:
-                    hashes[hash] = path
-
-        if duplicates:
-            self.detected = True
-            with open("./duplicates.json", "w") as file:
-                json.dump(duplicates, file, indent = 4)
-
-    def _omit(self, entry): 
-        # Resolve environment variables and convert to absolute paths for the paths to skip.
-        resolved_skip_paths = []
-
-        for skip_path in self.settings["default_paths_skip"] + self.settings["user_paths_skip"]:
-            resolved_path = os.path.abspath(os.path.expandvars(skip_path))
-            resolved_skip_paths.append(resolved_path)
-
-        # Check if the entrys path is in the list of paths to skip.
-        if os.path.abspath(entry.path) in resolved_skip_paths:
-            return True
-        
-        # Check filesize
-        if entry.stat().st_size  / (1024**2) > self.settings["max_file_size_mb"]:
-            return True
-
-        # Extract file name and extension to check if it should be skipped.
-        name_no_ext, file_extension = os.path.splitext(entry.name)
-
-        if entry.name in self.settings["user_filenames_skip"] or name_no_ext in self.settings["user_filenames_skip"]:
-            return True
-
-        if file_extension:
-            return file_extension in self.settings["default_exts_skip"] + self.settings["user_exts_skip"]
-                
+                    self._scan(scan_path, recursive, resume)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+
+                    for signum, handler in previous_handlers.items():
+                        signal.signal(signum, handler)
+
+        finally: # Also after an interrupted scan, so its counters don't end up in the stats of the resumed one
+            if profiler is not None:
+                self.stats.add_profile(profiler)
+
+            try:
+                self.stats.write()
+            except OSError as error:
+                self.error_dump.append(f"Could not write scan stats: {error}")
+
+            self.last_stats = self.stats
+            self.stats = ScanStats()
+            self.cache.stats = self.stats
+
+    def _scan(self, scan_path, recursive, resume):
+        # Walking runs in its own thread and hands entries over through a bounded queue,
+        # only the main thread touches the cache and the progress bar.
+        work_queue = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+        self.exclusions = ExclusionMatcher(self.settings) # Compiled once per scan, settings can change between scans
+        self.interrupted = False
+        self.completed_directories = {}
+        self.resume_state = {"roots": scan_path, "recursive": recursive}
+        resumed = self.load_resume_state() if resume else None
+
+        if resumed and (resumed["roots"] != scan_path or resumed["recursive"] != recursive): # From a scan of other paths
+            resumed = None
+
+        # With the sharded cache only the records under the scan paths are read, so eviction only sees those too
+        self.cache.ensure_loaded(scan_path)
+        self.cache.evict(self.settings.get("cache_evict_after_loads", 0), self.settings.get("cache_max_age_days", 0))
+
+        walker = self._create_walker(recursive, resumed["completed"] if resumed else None, self._known_directories())
+        self.progress = ProgressReporter(self.pbar, self.settings.get("progress_interval", 0.2))
+        self._last_checkpoint = time.monotonic()
+        self._bytes_since_checkpoint = 0
+
+        with self.stats.phase("precount"):
+            self.progress.start("Scanning", self._precount(walker, scan_path, recursive))
+
+        walker_thread = threading.Thread(target=self._walk_worker, args=(walker, scan_path, work_queue), daemon=True)
+        walker_thread.start()
+        seen_paths = set()
+        seen_directories = set()
+        unlisted_directories = [] # Listing failed, their records are kept rather than pruned
+        walk_failed = False
+        resumed_records = {}
+        scan_start = time.time()
+
+        if resumed: # Files of completed directories aren't walked again, their records count as seen
+            for record in self.cache.records_under(scan_path, recursive):
+                resumed_records.setdefault(os.path.dirname(record["PATH"]), []).append(record["PATH"])
+
+        while True:
+            try:
+                self._check_checkpoint()
+            except ScanInterrupted:
+                walker.cancelled = True
+
+                while work_queue.get() is not None: # Unblocks the walker so its thread can finish
+                    pass
+
+                walker_thread.join()
+                raise
+
+            item = work_queue.get()
+
+            if item is None: # Walker is done
+                break
+
+            kind, payload = item
+
+            if kind == "error":
+                self.error_dump.append(payload) # Make a logfile instead, maybe include cacheoperations
+                continue
+
+            if kind == "unlisted":
+                unlisted_directories.append(payload)
+                continue
+
+            if kind == "walk_failed": # Nothing can be pruned, it's unknown what the walk missed
+                self.error_dump.append(payload)
+                walk_failed = True
+                continue
+
+            if kind == "listed": # Everything in the directory has been indexed
+                path, subdirectories, mtime, entries = payload
+                self.completed_directories[path] = subdirectories
+                seen_directories.add(path)
+
+                # Changes within the same mtime tick as the listing wouldn't show, so recent directories are listed again next time
+                self.cache.set_directory(path, mtime if mtime < scan_start - MTIME_GRANULARITY else None, entries, subdirectories)
+                continue
+
+            if kind == "unchanged": # Nothing added or removed, the cached records are reused without a stat
+                records = list(self.cache.index.get(payload, {}).values())
+                seen_directories.add(payload)
+                self.completed_directories[payload] = list(walker.known[payload][1])
+
+                for record in records:
+                    seen_paths.add(record.path)
+                    self.cache.touch(record, self.settings.get("cache_evict_after_loads", 0))
+
+                self.stats.count("reused_files", len(records))
+                self.progress.advance(len(records), os.path.basename(payload), "UNCHANGED")
+                continue
+
+            if kind == "resumed":
+                paths = resumed_records.get(payload, [])
+                seen_paths.update(paths)
+                seen_directories.add(payload)
+                self.completed_directories[payload] = walker.completed[payload]
+                self.stats.count("resumed_files", len(paths))
+                self.progress.advance(len(paths), os.path.basename(payload), "RESUMED")
+                continue
+
+            if kind == "omitted": # Not part of the precount, so only shown
+                self.progress.advance(0, payload.name, "SKIPPING")
+                continue
+
+            seen_paths.add(payload.path)
+
+            with self.stats.phase("cache_lookups"):
+                in_cache = self._check_in_cache(payload) # Checks for an identical match
+
+                if not in_cache:
+                    self._add_to_cache(payload) # Only indexed here, hashing is deferred until all sizes are known
+
+            self.stats.count("cache_hits" if in_cache else "cache_misses")
+            self.progress.advance(1, payload.name, "CACHED" if in_cache else "INDEXING")
+
+        walker_thread.join()
+        self.stats.merge(walker.stats)
+
+        if not walk_failed:
+            with self.stats.phase("prune"):
+                pruned = self.cache.prune(scan_path, seen_paths, recursive, unlisted_directories) # Drops deleted, moved and newly excluded files so they aren't reported
+                self.stats.count("records_pruned", pruned)
+                self.cache.prune_directories(scan_path, seen_directories, recursive, unlisted_directories)
+
+        self._hash_candidates()
+
+        if self.settings.get("song_fingerprint", False):
+            with self.stats.phase("song_fingerprinting"):
+                self._fingerprint_songs(scan_path, recursive)
+
+        self.cache.metadata["hash_algorithm"] = self.settings["hash_algorithm"]
+        self.cache.write()
+        self._remove_resume_state() # Everything is in the cache, nothing left to resume
+
+        with self.stats.phase("duplicate_grouping"):
+            self._identify_duplicates(scan_path, recursive)
+
+        self.progress.flush()
+
+    def apply_changes(self, scan_path, recursive, changed, removed):
+        """Brings the cache and the report up to date with files changed or removed since the last scan of the
+        paths, without walking them again (used by watch mode). Changed directories are walked, since
+        everything in a moved-in directory is new. Only files whose size now collides are hashed."""
+        for path in removed:
+            record = self.cache.get(path)
+
+            if record is not None:
+                self.cache.remove(record)
+                continue
+
+            prefix = os.path.join(path, "") # Otherwise a whole directory was removed or moved away
+
+            for directory in [directory for directory in self.cache.index if directory == path or directory.startswith(prefix)]:
+                for record in list(self.cache.index[directory].values()):
+                    self.cache.remove(record)
+
+        for path in changed:
+            try:
+                stat = os.stat(path) if self.settings.get("follow_symlinks", False) else os.lstat(path)
+            except FileNotFoundError: # Gone again before it settled
+                record = self.cache.get(path)
+
+                if record is not None:
+                    self.cache.remove(record)
+                continue
+            except OSError as error:
+                self.error_dump.append(str(error))
+                continue
+
+            name = os.path.basename(path)
+
+            if os.path.isdir(path):
+                if recursive and not self.exclusions.skip_dir(path, name):
+                    for kind, payload in self._create_walker(recursive).walk([path]):
+                        if kind == "file" and not self._check_in_cache(payload):
+                            self._add_to_cache(payload)
+
+                continue
+
+            if not os.path.isfile(path) or self.exclusions.skip_file(path, name, stat.st_size):
+                continue
+
+            entry = WalkEntry(path, name, stat.st_size, stat.st_mtime, stat.st_ino, stat.st_dev)
+
+            if not self._check_in_cache(entry):
+                self._add_to_cache(entry)
+
+        self._hash_candidates()
+
+        if self.settings.get("song_fingerprint", False):
+            with self.stats.phase("song_fingerprinting"):
+                self._fingerprint_songs(scan_path, recursive)
+
+        with self.stats.phase("duplicate_grouping"):
+            self._identify_duplicates(scan_path, recursive)
+
+        self._remove_resume_state() # A checkpoint while hashing writes one, but there's no scan to resume
+
+    def _install_signal_handlers(self):
+        # Handlers only set a flag, the main thread checkpoints and stops at its next check so the cache
+        # is never written halfway through an update. A second signal stops right away.
+        def handler(signum, frame):
+            if self.interrupted:
+                raise KeyboardInterrupt
+
+            self.interrupted = True
+
+        previous_handlers = {}
+
+        if threading.current_thread() is not threading.main_thread(): # Signals can only be handled on the main thread
+            return previous_handlers
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, handler)
+
+        return previous_handlers
+
+    def _check_checkpoint(self):
+        """Checkpoints the cache once "checkpoint_interval" seconds or "checkpoint_mb" hashed bytes have passed
+        since the last one, or when the scan was interrupted, which then raises ScanInterrupted."""
+        interval = self.settings.get("checkpoint_interval", 300)
+        byte_limit = self.settings.get("checkpoint_mb", 1024) * 1024**2
+
+        if not self.interrupted:
+            if not (interval and time.monotonic() - self._last_checkpoint >= interval) and not (byte_limit and self._bytes_since_checkpoint >= byte_limit):
+                return
+
+        with self.stats.phase("checkpoints"):
+            self.cache.write()
+            self._write_resume_state()
+
+        self.stats.count("checkpoints")
+        self._last_checkpoint = time.monotonic()
+        self._bytes_since_checkpoint = 0
+
+        if self.interrupted:
+            raise ScanInterrupted("Scan interrupted, progress has been saved and the scan can be resumed.")
+
+    def load_resume_state(self):
+        """Returns the state of an interrupted scan ({"roots", "recursive", "completed"}), or None."""
+        try:
+            with open(RESUME_PATH, "r") as file:
+                return json.load(file)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def _write_resume_state(self):
+        temp_path = RESUME_PATH + ".tmp"
+
+        with open(temp_path, "w") as file:
+            json.dump({**self.resume_state, "completed": self.completed_directories}, file)
+
+        os.replace(temp_path, RESUME_PATH)
+
+    def _remove_resume_state(self):
+        if os.path.exists(RESUME_PATH):
+            os.remove(RESUME_PATH)
+
+    def _known_directories(self):
+        """Directories from earlier scans that don't need to be listed again while their mtime stays the same,
+        path to (mtime, subdirectories). Empty in paranoid mode and after the exclusion settings changed."""
+        walk_settings = {key: self.settings.get(key) for key in (*SETTINGS_KEYS, "follow_symlinks")}
+        changed = self.cache.metadata.get("walk_settings") != walk_settings
+        self.cache.metadata["walk_settings"] = walk_settings
+
+        if changed or self.paranoid or self.settings.get("paranoid_rescan", False):
+            return {}
+
+        known = {}
+
+        for path, (mtime, entries, subdirectories) in self.cache.directories.items():
+            # A directory whose records were evicted or never cached doesn't add up, so it's listed again
+            if mtime is not None and entries == len(self.cache.index.get(path, ())) + len(subdirectories):
+                known[path] = (mtime, subdirectories)
+
+        return known
+
+    def _create_walker(self, recursive, completed=None, known=None):
+        follow_symlinks = self.settings.get("follow_symlinks", False)
+
+        if self.settings.get("scan_engine", "thread") == "async":
+            return AsyncDirectoryWalker(self.exclusions, recursive, follow_symlinks, completed, known,
+                                        self.settings.get("async_concurrency", 32),
+                                        self.settings.get("async_mount_concurrency", 8),
+                                        self.settings.get("async_mount_limits", {}),
+                                        self.settings.get("async_injected_latency", 0)) # Only for testing, seconds per blocking call
+
+        return DirectoryWalker(self.exclusions, recursive, follow_symlinks, completed, known)
+
+    def _walk_worker(self, walker, scan_path, work_queue):
+        try:
+            walker.walk_into(scan_path, work_queue)
+        except Exception as error: # Reported instead of ending the walk as if it had finished
+            work_queue.put(("walk_failed", f"Walk stopped early ({error!r}), cached records were kept."))
+        finally:
+            work_queue.put(None)
+
+    def _add_to_cache(self, entry):
+        # A modified file replaces its old record, otherwise the stale hashes would linger as ghost duplicates
+        self.cache.add({
+            "PATH": entry.path,
+            "MODIFIED_TIME": entry.mtime,
+            "SIZE": entry.size,
+            "DEVICE": entry.device,
+            "INODE": entry.inode
+        })
+
+    def _hash_candidates(self):
+        """Narrows the cached files down to confirmed duplicates in three stages.
+
+        Files are grouped by size first, since files of different sizes can't be identical. Only size
+        collisions get a partial hash of their head and tail blocks with the fast screening algorithm, and
+        only partial hash collisions are read in full with the configured hashing algorithm. Small groups
+        of large files are compared in lockstep instead (see _use_lockstep)."""
+        algorithm = self.settings["hash_algorithm"]
+
+        # Partial hashes are a couple of small seeks per file, so they're bound by I/O latency rather than CPU
+        partial_jobs = [file_info for group in self._group_records("SIZE") for file_info in group if "PARTIAL_HASH" not in file_info]
+        partial_hash = functools.partial(calculate_partial_hash, algorithm=self.settings["screen_algorithm"], block_size=self.settings.get("partial_hash_size", 4096))
+
+        with self.stats.phase("partial_hashing"), self._create_executor("io_workers") as executor:
+            self._run_hash_jobs(executor, partial_hash, "PARTIAL_HASH", partial_jobs)
+
+        compare_groups = []
+        full_jobs = []
+
+        for group in self._group_records("SIZE", "PARTIAL_HASH"):
+            if all(algorithm in file_info or DIFFERS_KEY in file_info for file_info in group): # Settled by an earlier hash or comparison
+                continue
+
+            if self._use_lockstep(group):
+                compare_groups.append(group)
+            else:
+                full_jobs.extend(file_info for file_info in group if algorithm not in file_info)
+
+        full_hash = functools.partial(calculate_hash, algorithm=algorithm, chunk_size=self.settings.get("hash_chunk_size", 0))
+
+        with self.stats.phase("lockstep_comparison"), self._create_executor("hash_workers", self.settings.get("hash_executor", "thread") == "process") as executor:
+            self._run_compare_jobs(executor, compare_groups)
+
+        with self.stats.phase("full_hashing"), self._create_executor("hash_workers", self.settings.get("hash_executor", "thread") == "process") as executor:
+            self._run_hash_jobs(executor, full_hash, algorithm, full_jobs)
+
+    def _use_lockstep(self, group):
+        """Lockstep comparison pays off for a few large files, reading stops as soon as they differ. Many
+        files or small ones are hashed, every file then gets a digest cached for later scans. So are groups
+        that a new file joined after an earlier comparison, the files that differed have no digest to match against."""
+        if any(self.settings["hash_algorithm"] in file_info or DIFFERS_KEY in file_info for file_info in group): # Hashing the rest only reads the new files
+            return False
+
+        distinct = len({inode_key(file_info) for file_info in group})
+        return 2 <= distinct <= self.settings.get("lockstep_max_files", 3) and group[0]["SIZE"] >= self.settings.get("lockstep_min_size_mb", 8) * 1024**2
+
+    def export_manifest(self, scan_path, recursive, file_path, host=None, base=None):
+        """Scans the paths and writes a manifest of them for merging with other hosts.
+
+        Size tiering only hashes files that collide on this host, but a file can have its duplicate on
+        another one, so every file without a full digest is hashed first. Digests are cached, so that's
+        only needed once per file. Returns the manifest id."""
+        self.scan_directory(scan_path, recursive)
+        algorithm = self.settings["hash_algorithm"]
+        jobs = [file_info for file_info in self.cache.records_under(scan_path, recursive) if algorithm not in file_info and "SIZE" in file_info]
+        full_hash = functools.partial(calculate_hash, algorithm=algorithm, chunk_size=self.settings.get("hash_chunk_size", 0))
+
+        with self._create_executor("hash_workers", self.settings.get("hash_executor", "thread") == "process") as executor:
+            self._run_hash_jobs(executor, full_hash, algorithm, jobs)
+
+        self.progress.flush()
+        self.cache.write()
+        self._remove_resume_state() # A checkpoint while hashing writes one, but the scan already finished
+        return write_manifest(self.cache.records_under(scan_path, recursive), scan_path, algorithm, file_path, host, base, recursive)
+
+    def _fingerprint_songs(self, scan_path, recursive):
+        """Collects what song matching needs, the chart digest and the song.ini metadata of every song folder.
+        Both are cached, and the audio and images are never read."""
+        algorithm = self.settings["hash_algorithm"]
+        self.song_folders = find_song_folders(self.cache.records_under(scan_path, recursive))
+
+        for ini_record, _, _ in self.song_folders.values():
+            if METADATA_KEY not in ini_record:
+                try:
+                    ini_record[METADATA_KEY] = read_song_metadata(ini_record["PATH"])
+                    self.cache.updated(ini_record)
+                except OSError as error:
+                    self.error_dump.append(str(error))
+
+        # Charts are only a few KB, but there can be tens of thousands of them
+        chart_jobs = [chart_record for _, chart_record, _ in self.song_folders.values() if algorithm not in chart_record]
+        chart_hash = functools.partial(calculate_hash, algorithm=algorithm, chunk_size=self.settings.get("hash_chunk_size", 0))
+
+        with self._create_executor("io_workers") as executor:
+            self._run_hash_jobs(executor, chart_hash, algorithm, chart_jobs)
+
+        self.stats.count("song_folders", len(self.song_folders))
+
+    def _create_executor(self, workers_key, use_processes=False):
+        workers = max(1, self.settings.get(workers_key, 4))
+
+        if use_processes:
+            return ProcessPoolExecutor(max_workers=workers)
+
+        return ThreadPoolExecutor(max_workers=workers) # hashlib releases the GIL on large buffers, threads are usually enough
+
+    def _run_hash_jobs(self, executor, hash_function, key, jobs):
+        partial = key == "PARTIAL_HASH"
+        links = {}
+
+        # Hardlinks (and the same file reached twice through symlinks or mounts) share an inode, so each inode is only read once
+        for file_info in jobs:
+            links.setdefault(inode_key(file_info), []).append(file_info)
+
+        self.stats.count("hardlinks_not_hashed", len(jobs) - len(links))
+        self.progress.start("Partial hashing" if partial else "Hashing", sum(self._bytes_to_hash(linked[0], partial) for linked in links.values()), "B", True)
+        futures = [(linked, executor.submit(timed_call, hash_function, linked[0]["PATH"], linked[0]["SIZE"])) for linked in links.values()]
+
+        # Results are collected in submission order so the cache doesn't depend on thread scheduling
+        for linked, future in futures:
+            file_info = linked[0]
+
+            try:
+                self._check_checkpoint()
+            except ScanInterrupted:
+                for _, pending in futures:
+                    pending.cancel() # Otherwise leaving the executor would wait for every queued file
+
+                raise
+
+            try:
+                digest, elapsed = future.result()
+                bytes_read = self._bytes_to_hash(file_info, partial)
+
+                for link in linked:
+                    link[key] = digest
+                    self.cache.updated(link)
+
+                self.stats.count("partial_hashes" if partial else "full_hashes")
+                self.stats.count("bytes_hashed", bytes_read)
+                self._bytes_since_checkpoint += bytes_read
+                self.stats.record_slow("partial_hash_files" if partial else "full_hash_files", file_info["PATH"], elapsed)
+                self.progress.advance(bytes_read, os.path.basename(file_info["PATH"]), "PARTIAL HASH" if partial else "CALCULATING HASH")
+
+            except FileNotFoundError as error: # File was removed since it was cached, drop the record
+                self.error_dump.append(str(error))
+                self.cache.remove(file_info)
+
+            except (PermissionError, IOError) as error:
+                self.error_dump.append(str(error))
+
+    def _run_compare_jobs(self, executor, groups):
+        # Files that stay identical to the end get the digest computed while comparing, the others are marked
+        # as differing so later scans don't read them again until their group changes.
+        algorithm = self.settings["hash_algorithm"]
+        jobs = []
+
+        for group in groups:
+            links = {}
+
+            for file_info in group: # Hardlinks are compared once, like they're hashed once
+                links.setdefault(inode_key(file_info), []).append(file_info)
+
+            jobs.append((group[0]["SIZE"], {linked[0]["PATH"]: linked for linked in links.values()}))
+
+        self.progress.start("Comparing", sum(size * len(job) for size, job in jobs), "B", True)
+        futures = [(size, job, executor.submit(timed_call, compare_files, list(job), size, algorithm, self.settings.get("hash_chunk_size", 0))) for size, job in jobs]
+
+        for size, job, future in futures:
+            first_path = next(iter(job))
+
+            try:
+                self._check_checkpoint()
+            except ScanInterrupted:
+                for _, _, pending in futures:
+                    pending.cancel()
+
+                raise
+
+            try:
+                (identical, bytes_read), elapsed = future.result()
+
+                identical_paths = set()
+
+                for paths, digest in identical:
+                    identical_paths.update(paths)
+
+                    for path in paths:
+                        for link in job[path]:
+                            link[algorithm] = digest
+                            self.cache.updated(link)
+
+                for path in job.keys() - identical_paths:
+                    for link in job[path]:
+                        link[DIFFERS_KEY] = "differs"
+                        self.cache.updated(link)
+
+                self.stats.count("lockstep_groups")
+                self.stats.count("lockstep_files_dropped", len(job) - len(identical_paths))
+                self.stats.count("bytes_compared", bytes_read)
+                self._bytes_since_checkpoint += bytes_read
+                self.stats.record_slow("lockstep_groups", first_path, elapsed)
+                self.progress.advance(size * len(job), os.path.basename(first_path), "COMPARING")
+
+            except FileNotFoundError as error: # Removed since it was cached, the rest of the group is compared on the next scan
+                self.error_dump.append(str(error))
+
+                for link in job.get(error.filename, []):
+                    self.cache.remove(link)
+
+            except (PermissionError, IOError) as error:
+                self.error_dump.append(str(error))
+
+    def _bytes_to_hash(self, file_info, partial):
+        if partial: # Only the head and tail blocks are read
+            return min(file_info["SIZE"], 2 * self.settings.get("partial_hash_size", 4096))
+
+        return file_info["SIZE"]
+
+    def _group_records(self, *keys):
+        groups = {}
+
+        for instance in self.cache.records():
+            if all(key in instance for key in keys):
+                groups.setdefault(tuple(instance[key] for key in keys), []).append(instance)
+
+        return [group for group in groups.values() if len(group) > 1]
+
+    def _identify_duplicates(self, scan_path, recursive): # Needs tweaking for multiple runs, and persistant detected duplicates.
+        algorithm = self.settings["hash_algorithm"]
+        report = DuplicateReport(algorithm)
+        directory_index = {}
+
+        # Directory trees are only complete in the cache under recursively scanned paths
+        if recursive and self.settings.get("detect_directories", True):
+            with self.stats.phase("directory_hashing"):
+                directory_groups = find_duplicate_directories(self.cache.records_under(scan_path, True), scan_path, algorithm)
+
+            for i, (_, _, _, directories) in enumerate(directory_groups):
+                directory_index.update((directory, i) for directory in directories)
+
+            directory_records = {} # Directory of a group to the records under it, nested groups' files go to every group above them
+
+            if directory_groups:
+                for record in self.cache.records_under(scan_path, True):
+                    for directory in enclosing_directories(record["PATH"], directory_index):
+                        directory_records.setdefault(directory, []).append(record)
+
+            for digest, size, file_count, directories in directory_groups:
+                # Copies inside an enclosing directory group are counted by it, like in file groups one of them stands in for the rest
+                copies = {}
+
+                for directory in directories:
+                    i = covering_group(directory, directory_index)
+                    copies.setdefault(directory if i is None else i, directory)
+
+                records = [record for directory in copies.values() for record in directory_records.get(directory, ())]
+                counted = sum(1 for key in copies if not isinstance(key, int)) * file_count
+                report.add_directory_group(digest, size, file_count, directories, records, counted)
+
+            self.stats.count("directory_groups", len(directory_groups))
+
+        # Only files confirmed by a full hash are compared
+        for group in self._group_records("SIZE", algorithm):
+            covering = {covering_group(file_info["PATH"], directory_index) for file_info in group} if directory_index else {None}
+
+            if len(covering) == 1 and None not in covering: # Every copy is inside the same identical directory group
+                self.stats.count("file_groups_collapsed")
+                continue
+
+            counted = None
+
+            if directory_index: # The directory groups already count the copies inside them, one of each group stands in for the rest
+                representatives = {}
+
+                for file_info in sorted(group, key = lambda file_info: file_info["PATH"]):
+                    i = covering_group(file_info["PATH"], directory_index)
+                    representatives.setdefault(file_info["PATH"] if i is None else i, file_info)
+
+                group = list(representatives.values())
+                counted = sum(1 for key in representatives if not isinstance(key, int))
+
+            report.add_group(group[0][algorithm], group[0]["SIZE"], group, counted)
+
+        for fingerprint, directories in group_songs(self.song_folders, algorithm):
+            covering = {covering_group(os.path.join(directory, SONG_INI), directory_index) for directory, _, _ in directories} if directory_index else {None}
+
+            if len(covering) == 1 and None not in covering: # Byte for byte identical, already reported as a directory group
+                continue
+
+            report.add_song_group(fingerprint, directories)
+            self.stats.count("song_groups")
+
+        self.song_folders = {}
+
+        self.detected = len(report) > 0
+        report.write() # Always written so a previous report doesn't linger when nothing is found
+
     def _check_in_cache(self, entry):
-        cached = False
-        if entry.name in self.cache.data:
+        # Compares the filedata to the cached record of the same path to see if its the same.
+        file_info = self.cache.get(entry.path)
+
+        if file_info is None or file_info["MODIFIED_TIME"] != entry.mtime:
+            return False
 
-            # Compares the filedata to the corresponding key in cache to see if its the same.
-            for file_info in self.cache.data[entry.name]:
-                if file_info["PATH"] == entry.path and file_info["MODIFIED_TIME"] == entry.stat().st_mtime:
-                    cached = True
+        if "INODE" not in file_info: # Records from older caches lack these
+            file_info.update({"SIZE": entry.size, "DEVICE": entry.device, "INODE": entry.inode})
+            self.cache.updated(file_info)
 
-        return cached
+        self.cache.touch(file_info, self.settings.get("cache_evict_after_loads", 0))
+        return True
                 
-    def _update_pbar(self, entry, skipped=False):
-        if self.pbar is not None:
-            self.pbar.set_description(f"{entry.name:<30}: {'SKIPPING' if skipped else 'CALCULATING HASH'}")
-            self.pbar.update(1)
+    def _precount(self, walker, scan_path, recursive):
+        # Gives the progress bar a total, either from the files cached under the scan paths last time or from a quick listing
+        precount = self.settings.get("progress_precount", "cache")
 
-            #ONLY FOR DEBUG
-            #time.sleep(0.05)
-            #entry_verdict.append(f"{filename:<30}: {'SKIPPING' if in_cache else 'CALCULATING HASH'}")
+        if self.pbar is None or precount == "none":
+            return None
+
+        if precount == "walk":
+            return walker.count_files(scan_path)
+
+        return sum(1 for _ in self.cache.records_under(scan_path, recursive)) or None
 
     def print_data(self):
         if self.detected:
-            print(f"\n\nSCAN FINISHED: See \"{os.getcwd()}\\duplicates.json\" for identified duplicates.")
+            print(f"\n\nSCAN FINISHED: See \"{os.path.abspath(REPORT_PATH)}\" for identified duplicates.")
         else:
             print("\n\nSCAN FINISHED: No duplicates were detected.")
 
+        if self.last_stats is not None:
+            phases = self.last_stats.phases
+            counters = self.last_stats.counters
+            print(f"\n{counters.get('files_found', 0)} files in {phases.get('scan', 0):.1f}s, {counters.get('bytes_hashed', 0) / 1024**2:.1f} MB hashed, "
+                  f"{counters.get('cache_hits', 0)} cache hits. See \"{os.path.abspath(STATS_PATH)}\" for details.")
+
         if len(self.error_dump) > 0:
             print("\n\nErrors encountered during the scan:")
 
@@ -154,13 +741,28 @@ class FileOperations:
         #    print("\n", item) 
 
     def validate_hash_algo(self): #move to main?
-        if self.settings["hash_algorithm"] not in hashlib.algorithms_available:
-            print(f"\nUnsupported hashing algorithm: ('{self.settings["hash_algorithm"]}') defaulting to md5")
+        algorithms = available_algorithms()
+        self.settings["hash_algorithm"] = self.settings["hash_algorithm"].lower()
+        self.settings["screen_algorithm"] = self.settings.get("screen_algorithm", "blake2b-64").lower()
+
+        if self.settings["hash_algorithm"] not in algorithms:
+            print(f"\nUnsupported hashing algorithm: ('{self.settings['hash_algorithm']}') defaulting to md5")
             self.settings["hash_algorithm"] = "md5"
-        
-        # Check what hash algorithm was last used and compare to the one in settings.
-        cache_hash = self.cache.metadata["hash_algorithm"]
 
-        if self.settings["hash_algorithm"] != cache_hash and cache_hash != "":
-            print("\nHashing algorithm changed, clearing cache.")
-            self.cache.clear()
+        if self.settings["screen_algorithm"] not in algorithms:
+            print(f"\nUnsupported screening algorithm: ('{self.settings['screen_algorithm']}') defaulting to blake2b-64 (xxhash algorithms need 'pip install xxhash')")
+            self.settings["screen_algorithm"] = "blake2b-64"
+
+        # Digests of every algorithm are kept side by side in the cache, so switching hash_algorithm only hashes
+        # the files that lack a digest of the new algorithm. Partial hashes only hold one algorithm though.
+        cache_screen = self.cache.metadata.get("screen_algorithm")
+
+        if cache_screen and self.settings["screen_algorithm"] != cache_screen:
+            print("\nScreening algorithm changed, dropping cached partial hashes.")
+            self.cache.ensure_loaded() # Shards that aren't loaded would keep the old ones
+
+            for file_info in self.cache.records():
+                if file_info.pop("PARTIAL_HASH", None) is not None:
+                    self.cache.updated(file_info)
+
+        self.cache.metadata["screen_algorithm"] = self.settings["screen_algorithm"]
@@ -0,0 +1,176 @@
+import os
+import time
+import hashlib
+import threading
+
+try: # Optional, much faster than anything in hashlib for screening
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Non-cryptographic or truncated digests, meant for screening candidates rather than confirming duplicates
+FAST_ALGORITHMS = {
+    "blake2b-64": lambda: hashlib.blake2b(digest_size = 8)
+}
+if xxhash is not None:
+    FAST_ALGORITHMS.update({
+        "xxh64": xxhash.xxh64,
+        "xxh3_64": xxhash.xxh3_64,
+        "xxh3_128": xxhash.xxh3_128
+    })
+
+# Record key of files a lockstep comparison found to differ from every other file of their size, dropped with the record when the file changes
+DIFFERS_KEY = "LOCKSTEP_DIFFERS"
+
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 4 * 1024**2
+
+_local = threading.local() # One reusable read buffer per hashing thread
+
+
+def available_algorithms():
+    # shake algorithms need a digest length, so they can't be used as is
+    return sorted(algorithm for algorithm in hashlib.algorithms_available | set(FAST_ALGORITHMS) if not algorithm.startswith("shake"))
+
+
+def new_hash(algorithm):
+    if algorithm in FAST_ALGORITHMS:
+        return FAST_ALGORITHMS[algorithm]()
+
+    return hashlib.new(algorithm)
+
+
+def benchmark_algorithms(algorithms, sample_size = 64 * 1024**2):
+    """Hashes the same in-memory sample with every algorithm and returns the throughput in MB/s, fastest first."""
+    sample = memoryview(os.urandom(sample_size))
+    results = {}
+
+    for algorithm in algorithms:
+        hash_obj = new_hash(algorithm)
+        start = time.perf_counter()
+
+        for offset in range(0, sample_size, MAX_BUFFER_SIZE):
+            hash_obj.update(sample[offset:offset + MAX_BUFFER_SIZE])
+
+        hash_obj.hexdigest()
+        results[algorithm] = sample_size / 1024**2 / (time.perf_counter() - start)
+
+    return dict(sorted(results.items(), key = lambda result: result[1], reverse = True))
+
+
+def buffer_size_for(size, chunk_size = 0):
+    """Read size for a file, chunk_size overrides it when set. Scales with the file so small files
+    don't get a huge buffer and big files don't need thousands of reads."""
+    if chunk_size:
+        return chunk_size
+
+    return min(MAX_BUFFER_SIZE, max(MIN_BUFFER_SIZE, size // 16))
+
+
+def _get_buffer(buffer_size):
+    buffer = getattr(_local, "buffer", None)
+
+    if buffer is None or len(buffer) < buffer_size:
+        buffer = bytearray(buffer_size)
+        _local.buffer = buffer
+
+    return memoryview(buffer)[:buffer_size]
+
+
+def _advise(file, advice):
+    # Hints are best effort, posix_fadvise doesn't exist on Windows and some filesystems reject it
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, advice)
+        except OSError:
+            pass
+
+
+# Module level so they can be pickled to a process pool
+def calculate_hash(path, size, algorithm, chunk_size = 0):
+    hash_obj = new_hash(algorithm)
+    buffer = _get_buffer(buffer_size_for(size, chunk_size))
+
+    # Unbuffered, readinto fills the same buffer every time instead of allocating a new bytes object per chunk.
+    # Read in binary to eliminate etc newline differences between OS's.
+    with open(path, "rb", buffering = 0) as file:
+        _advise(file, getattr(os, "POSIX_FADV_SEQUENTIAL", None))
+
+        while True:
+            read = file.readinto(buffer)
+
+            if not read:
+                break
+
+            hash_obj.update(buffer[:read])
+
+        # The file won't be read again (the hash is cached), so don't let it push other data out of the page cache
+        _advise(file, getattr(os, "POSIX_FADV_DONTNEED", None))
+
+    return hash_obj.hexdigest()
+
+
+def calculate_partial_hash(path, size, algorithm, block_size):
+    hash_obj = new_hash(algorithm)
+
+    with open(path, "rb", buffering = 0) as file: # Head and tail blocks, files that differ usually do so at either end (headers, tags)
+        hash_obj.update(file.read(block_size))
+
+        if size > block_size:
+            file.seek(max(block_size, size - block_size))
+            hash_obj.update(file.read(block_size))
+
+    return hash_obj.hexdigest()
+
+
+def compare_files(paths, size, algorithm, chunk_size = 0):
+    """Reads the files in lockstep and splits them apart at the first block where they differ.
+
+    Files left on their own are dropped, so a group that differs early is settled without reading the
+    rest of it. Each group of identical files is hashed once while it's read, so they still get a digest.
+    Returns ([(paths, digest), ...], bytes read)."""
+    buffer_size = buffer_size_for(size, chunk_size)
+    files = {}
+    groups = [(list(paths), new_hash(algorithm))]
+    finished = []
+    bytes_read = 0
+
+    try:
+        for path in paths:
+            files[path] = open(path, "rb", buffering = 0)
+            _advise(files[path], getattr(os, "POSIX_FADV_SEQUENTIAL", None))
+
+        while groups:
+            next_groups = []
+
+            for group_paths, hash_obj in groups:
+                # Plain reads instead of readinto, every file needs its own block to compare against the others
+                blocks = {}
+
+                for path in group_paths:
+                    block = files[path].read(buffer_size)
+                    bytes_read += len(block)
+                    blocks.setdefault(block, []).append(path)
+
+                for block, block_paths in blocks.items():
+                    if len(block_paths) < 2: # Differs from every other file in the group
+                        continue
+
+                    # Only copied when the group splits, an identical group keeps updating the same hash
+                    block_hash = hash_obj if len(blocks) == 1 else hash_obj.copy()
+
+                    if not block: # All at the end together
+                        finished.append((block_paths, block_hash.hexdigest()))
+                        continue
+
+                    block_hash.update(block)
+                    next_groups.append((block_paths, block_hash))
+
+            groups = next_groups
+
+    finally:
+        for file in files.values():
+            _advise(file, getattr(os, "POSIX_FADV_DONTNEED", None))
+            file.close()
+
+    return finished, bytes_read
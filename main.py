@@ -3,41 +3,61 @@ import platform
 import ctypes
 import json
 import re
+import argparse
 from tqdm import tqdm
-from file_operations import FileOperations
+from file_operations import FileOperations, ScanInterrupted
+from report import REPORT_PATH
+from dedupe import Deduplicator, UNDO_PATH
+from hashing import available_algorithms, benchmark_algorithms
 from menu import Menu
 
 
 class CloneSweeper:
     """Entry point and core controller for the CloneSweeper application."""
-    def __init__(self):
+    def __init__(self, profile = False, paranoid = False):
         self.settings_path = ".\\settings.json"
         self.settings = self._load_settings()
         self.fo = None
+        self.profile = profile
+        self.paranoid = paranoid
         # Move cache here?
 
     def run(self):
         print ("\nDisclaimer: Use at your own risk. No warranty is provided. The creator is not liable for any damages.")
         self._is_elevated()
         self.fo = FileOperations(self.settings)
+        self.fo.profile = self.profile
+        self.fo.paranoid = self.paranoid
 
         option_menu = Menu()
         option_menu.add_option("Exclude Paths", self._exclude_paths)
         option_menu.add_option("Exclude Extensions", self._exclude_extensions)
         option_menu.add_option("Exclude Filenames", self._exclude_filenames)
         option_menu.add_option("Clear user defined exclusions", self._clear_user_exclusions)
+        option_menu.add_option("Benchmark hashing algorithms", self._benchmark_hashes)
         option_menu.add_option("Back", option_menu.exit)
 
         main_menu = Menu("CLONE-SWEEPER", f"Current Directory: {os.getcwd()}", "Choice", True)
         main_menu.add_option("Start", self._prepare_scan)
         main_menu.add_option("Clear Cache", self.fo.cache.clear)
         main_menu.add_option("Clear duplicates list", self._clear_duplicates)
+        main_menu.add_option("Deduplicate with links", self._deduplicate)
+        main_menu.add_option("Undo deduplication", self._undo_deduplication)
         main_menu.add_option("Settings", option_menu.display)
         main_menu.add_option("View JSON Settings", self._show_settings)
         main_menu.add_option("Exit", main_menu.exit)
         main_menu.display()
 
     def _prepare_scan(self):
+        resume_state = self.fo.load_resume_state()
+
+        if resume_state:
+            print(f"\nAn interrupted scan of {resume_state['roots']} can be resumed, {len(resume_state['completed'])} directories are already done.")
+
+            if self._validate_input("\nResume it(Y/N): "):
+                self._start_scan(resume_state["roots"], resume_state["recursive"], True)
+                return
+
         scan_recursive = self._validate_input("\nRecursive scan(Y/N): ")
 
         while True:
@@ -54,21 +74,69 @@ class CloneSweeper:
                     self._start_scan(non_redundant_paths, scan_recursive)
                     break
 
-    def _start_scan(self, dir_path, scan_recursive):
+    def _start_scan(self, dir_path, scan_recursive, resume = False):
         print("\n")
         #move FileOperation object creation here
 
         # Indeterminate progress bar
         with tqdm(position = 0, leave = True, unit = " files") as pbar:
             self.fo.pbar = pbar 
-            self.fo.scan_directory(dir_path, scan_recursive)
+
+            try:
+                self.fo.scan_directory(dir_path, scan_recursive, resume)
+            except ScanInterrupted as e:
+                print(f"\n\n{e}")
+                return
 
         self.fo.print_data()
 
+    def _benchmark_hashes(self):
+        print("\nHashing a 64 MB sample with every available algorithm, this can take a moment.\n")
+
+        for algorithm, throughput in benchmark_algorithms(available_algorithms()).items():
+            print(f"   {algorithm:<15}: {throughput:>8.0f} MB/s")
+
+    def _deduplicate(self):
+        if not os.path.exists(REPORT_PATH):
+            print("\nNo duplicates list, run a scan first.")
+            return
+
+        mode = self.settings.get("dedupe_mode", "hardlink")
+        print(f"\nEvery duplicate will be replaced with a {mode} to the oldest copy, files are compared byte for byte first.")
+        print("Hardlinked files share their content, editing one of them changes all of them.")
+
+        if not self._validate_input("\nContinue(Y/N): "):
+            return
+
+        try:
+            deduplicator = Deduplicator(mode)
+            linked, bytes_freed = deduplicator.deduplicate()
+        except (OSError, ValueError) as e:
+            print(f"\nDeduplication failed: {e}")
+            return
+
+        for error in deduplicator.error_dump:
+            print(f"   {error}")
+
+        print(f"\nLinked {linked} files, freed {bytes_freed / 1024**2:.1f} MB. Undo log: \"{os.path.abspath(UNDO_PATH)}\"")
+
+    def _undo_deduplication(self):
+        if not os.path.exists(UNDO_PATH):
+            print("\nNothing to undo.")
+            return
+
+        deduplicator = Deduplicator()
+        restored = deduplicator.undo()
+
+        for error in deduplicator.error_dump:
+            print(f"   {error}")
+
+        print(f"\nRestored {restored} files.")
+
     def _clear_duplicates(self):
         try:
-            with open("./duplicates.json", "w") as file:
-                json.dump({}, file, indent = 4)
+            if os.path.exists(REPORT_PATH):
+                os.remove(REPORT_PATH)
 
             print("\nDuplicates cleared.")
 
@@ -242,5 +310,10 @@ class CloneSweeper:
 
         
 if __name__ == "__main__":
-    app = CloneSweeper()
+    parser = argparse.ArgumentParser(description = "Finds duplicate files, see README.md.")
+    parser.add_argument("--profile", action = "store_true", help = "Profile scans with cProfile, results are added to scan_stats.json")
+    parser.add_argument("--paranoid", action = "store_true", help = "List and check every directory, even the ones unchanged since the last scan")
+    args = parser.parse_args()
+
+    app = CloneSweeper(args.profile, args.paranoid)
     app.run()
@@ -0,0 +1,205 @@
+import os
+import sys
+import gzip
+import json
+import uuid
+import socket
+import argparse
+from datetime import datetime
+from report import DuplicateReport, REPORT_PATH
+from cache_manager import SQLiteCacheBackend
+from songs import METADATA_KEY
+from hashing import DIFFERS_KEY
+
+MANIFEST_VERSION = 1
+MANIFEST_PATH = "./manifest.ndjson.gz"
+
+
+class ManifestError(Exception):
+    """Exceptions raised for manifests that can't be read or applied."""
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def write_manifest(records, roots, algorithm, file_path = MANIFEST_PATH, host = None, base = None, recursive = True):
+    """Writes the records of one host as a gzipped NDJSON manifest.
+
+    The first line is a header, every other line a compact ["f", path, size, mtime, device, inode, digests]
+    array. When base (a host state from load_manifests) is given, only records that changed since then
+    are written, plus ["r", path] lines for removed files under the roots (files under other roots of the
+    base weren't exported, so they're kept), and the header points to the base manifest. Returns the manifest id."""
+    host = host or socket.gethostname()
+    header = {
+        "type": "manifest",
+        "version": MANIFEST_VERSION,
+        "id": uuid.uuid4().hex,
+        "host": host,
+        "generated": datetime.now().isoformat(), # Orders manifests of a host when merging
+        "algorithm": algorithm,
+        "roots": roots,
+        "base": None
+    }
+
+    if base is not None:
+        if base["host"] != host:
+            raise ManifestError(f"Base manifest is from \"{base['host']}\", not \"{host}\".")
+
+        header["base"] = base["id"]
+
+    temp_path = file_path + ".tmp"
+    paths = set()
+
+    with gzip.open(temp_path, "wt", encoding = "utf-8", errors = "surrogateescape") as file:
+        file.write(json.dumps(header) + "\n")
+
+        for record in records:
+            entry = manifest_entry(record)
+            paths.add(entry[1])
+
+            if base is None or base["entries"].get(entry[1]) != entry:
+                file.write(json.dumps(entry) + "\n")
+
+        if base is not None:
+            for path in sorted(set(base["entries"]) - paths):
+                if _under_roots(path, roots, recursive):
+                    file.write(json.dumps(["r", path]) + "\n")
+
+    os.replace(temp_path, file_path)
+    return header["id"]
+
+
+def _under_roots(path, roots, recursive):
+    # Same test as CacheOperations.records_under
+    directory = os.path.join(os.path.dirname(path), "")
+    roots = [os.path.join(root, "") for root in roots]
+    return directory in roots or (recursive and any(directory.startswith(root) for root in roots))
+
+
+def manifest_entry(record):
+    # Every key that isn't file metadata or a marker is a digest, same as in the cache
+    digests = {key: value for key, value in record.items() if key not in SQLiteCacheBackend.RECORD_KEYS and key not in (METADATA_KEY, DIFFERS_KEY)}
+    return ["f", record["PATH"], record.get("SIZE"), record["MODIFIED_TIME"], record.get("DEVICE"), record.get("INODE"), digests]
+
+
+def read_manifest(file_path):
+    try:
+        with gzip.open(file_path, "rt", encoding = "utf-8", errors = "surrogateescape") as file:
+            header = json.loads(file.readline())
+
+            if header.get("type") != "manifest" or header.get("version") != MANIFEST_VERSION:
+                raise ManifestError(f"\"{file_path}\" is not a version {MANIFEST_VERSION} manifest.")
+
+            return header, [json.loads(line) for line in file]
+
+    except (OSError, EOFError, json.JSONDecodeError) as error:
+        raise ManifestError(f"Could not read \"{file_path}\" ({error}).")
+
+
+def load_manifests(file_paths):
+    """Reads manifests and applies them per host, full manifests first and then the incremental ones on top
+    of their base. Returns host to {"host", "id", "algorithm", "entries": {path: entry}}."""
+    manifests = sorted((read_manifest(file_path) for file_path in file_paths), key = lambda manifest: manifest[0]["generated"])
+    states = {}
+
+    for header, entries in manifests:
+        host = header["host"]
+
+        if header["base"] is None:
+            state = states[host] = {"host": host, "entries": {}}
+        else:
+            state = states.get(host)
+
+            if state is None or state["id"] != header["base"]:
+                raise ManifestError(f"Incremental manifest {header['id']} from \"{host}\" needs its base manifest {header['base']}.")
+
+        for entry in entries:
+            if entry[0] == "r":
+                state["entries"].pop(entry[1], None)
+            else:
+                state["entries"][entry[1]] = entry
+
+        state["id"] = header["id"]
+        state["algorithm"] = header["algorithm"]
+
+    return states
+
+
+def merge_manifests(file_paths, algorithm = None, cross_host_only = True):
+    """Finds duplicates across hosts from their manifests, without touching any of the files.
+
+    Files are grouped by size and digest, and paths in the report are prefixed with the host name.
+    Files without a digest of the algorithm (the first manifest's by default) are left out."""
+    states = load_manifests(file_paths)
+
+    if not states:
+        raise ManifestError("No manifests to merge.")
+
+    algorithm = algorithm or next(iter(states.values()))["algorithm"]
+    groups = {}
+
+    for host, state in states.items():
+        for _, path, size, mtime, device, inode, digests in state["entries"].values():
+            if algorithm in digests:
+                groups.setdefault((size, digests[algorithm]), []).append({
+                    "PATH": f"{host}:{path}",
+                    "MODIFIED_TIME": mtime,
+                    "SIZE": size,
+                    "DEVICE": f"{host}:{device}", # Inodes are only unique per host
+                    "INODE": inode,
+                    "HOST": host
+                })
+
+    report = DuplicateReport(algorithm)
+
+    for (size, digest), records in groups.items():
+        if len(records) < 2 or (cross_host_only and len({record["HOST"] for record in records}) < 2):
+            continue
+
+        report.add_group(digest, size, records)
+
+    return report
+
+
+def main():
+    # Export needs a scan, so it goes through FileOperations and the settings, merge only reads manifests
+    parser = argparse.ArgumentParser(description = "Exports scan manifests and merges manifests from several hosts into one duplicates report.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+
+    export_parser = subparsers.add_parser("export", help = "Scan paths and write a manifest of this host")
+    export_parser.add_argument("paths", nargs = "+")
+    export_parser.add_argument("--no-recursive", action = "store_true")
+    export_parser.add_argument("--output", default = MANIFEST_PATH)
+    export_parser.add_argument("--base", action = "append", default = [], metavar = "MANIFEST", help = "Earlier manifests of this host, only changes since them are written")
+    export_parser.add_argument("--host", help = "Name of this host, defaults to the hostname")
+
+    merge_parser = subparsers.add_parser("merge", help = "Find duplicates across manifests")
+    merge_parser.add_argument("manifests", nargs = "+")
+    merge_parser.add_argument("--output", default = REPORT_PATH)
+    merge_parser.add_argument("--algorithm", help = "Digest to compare, defaults to the one of the first manifest")
+    merge_parser.add_argument("--include-local", action = "store_true", help = "Also report duplicates within a single host")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "export":
+            from file_operations import FileOperations
+
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"), "r") as file:
+                settings = json.load(file)
+
+            base = load_manifests(args.base).get(args.host or socket.gethostname()) if args.base else None
+            fo = FileOperations(settings)
+            manifest_id = fo.export_manifest([os.path.abspath(path) for path in args.paths], not args.no_recursive, args.output, args.host, base)
+            print(f"Manifest {manifest_id} written to \"{os.path.abspath(args.output)}\".")
+        else:
+            report = merge_manifests(args.manifests, args.algorithm, not args.include_local)
+            report.write(args.output)
+            summary = report.summary()
+            print(f"{summary['groups']} duplicate groups, {summary['wasted_bytes'] / 1024**2:.1f} MB wasted. See \"{os.path.abspath(args.output)}\".")
+
+    except ManifestError as error:
+        print(error)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
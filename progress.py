@@ -0,0 +1,56 @@
+import time
+
+
+class ProgressReporter:
+    """Rate limited, batched updates of a tqdm progress bar.
+
+    Counts are accumulated and the description is only formatted and drawn once per interval, so
+    trees with many small files don't spend their time redrawing the terminal. Every stage resets the
+    bar with its own total and unit (files while walking, bytes while hashing), which gives tqdm a
+    real throughput based ETA. Only meant to be called from one thread."""
+    def __init__(self, pbar = None, interval = 0.2):
+        self.pbar = pbar
+        self.interval = interval
+        self.pending = 0
+        self.name = None
+        self.status = None
+        self.last_flush = 0
+
+    def start(self, stage, total = None, unit = " files", unit_scale = False):
+        if self.pbar is None:
+            return
+
+        self.flush()
+        self.pbar.reset(total = total)
+        self.pbar.unit = unit
+        self.pbar.unit_scale = unit_scale
+        self.pbar.set_description(stage)
+
+    def advance(self, amount = 1, name = None, status = None):
+        if self.pbar is None:
+            return
+
+        self.pending += amount
+
+        if name is not None:
+            self.name = name
+            self.status = status
+
+        now = time.monotonic()
+
+        if now - self.last_flush >= self.interval:
+            self.flush(now)
+
+    def flush(self, now = None):
+        if self.pbar is None:
+            return
+
+        if self.name is not None:
+            self.pbar.set_description(f"{self.name:<30}: {self.status}", refresh = False)
+            self.name = None
+
+        if self.pending:
+            self.pbar.update(self.pending)
+            self.pending = 0
+
+        self.last_flush = now or time.monotonic()
@@ -0,0 +1,86 @@
+import os
+import json
+from datetime import datetime
+from walker import inode_key
+
+REPORT_PATH = "./duplicates.ndjson"
+
+
+class DuplicateReport:
+    """Collects duplicate groups and streams them to an NDJSON file, one JSON object per line.
+
+    The first line is a summary with the totals, followed by one line per group ranked by the space
+    that would be reclaimed by keeping a single copy. File groups have the type "group", identical
+    directory trees the type "directory" and song folders with the same chart and song.ini metadata (but
+    possibly different audio or images) the type "song". Files that are already hardlinked to each other are marked
+    as such and don't count as wasted space. Tools can read the summary and the top groups without
+    loading the rest of the report."""
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        # (wasted bytes, digest, type, size, members, file count), file group members are the cache records themselves and
+        # directory group members (directories, files per directory). The file count leaves out files already counted by
+        # an enclosing directory group, so the summary counts every file once
+        self.groups = []
+
+    def __len__(self):
+        return len(self.groups)
+
+    def add_group(self, digest, size, records, counted = None):
+        # Hardlinked copies don't take up extra space, so only distinct inodes count as wasted
+        distinct_inodes = len({inode_key(record) for record in records})
+        self.groups.append(((distinct_inodes - 1) * size, digest, "group", size, records, len(records) if counted is None else counted))
+
+    def add_directory_group(self, digest, size, file_count, directories, records, counted):
+        # Same as add_group, files hardlinked across the trees only count once. records are the files of the trees that count as copies
+        wasted = sum({inode_key(record): record.get("SIZE", 0) for record in records}.values()) - size
+        self.groups.append((max(0, wasted), digest, "directory", size, (directories, file_count), counted))
+
+    def add_song_group(self, fingerprint, directories):
+        # The folders can differ in size, keeping the largest is assumed to keep the best audio
+        sizes = [size for _, size, _ in directories]
+        self.groups.append((sum(sizes) - max(sizes), fingerprint, "song", max(sizes), directories, sum(file_count for _, _, file_count in directories)))
+
+    def summary(self):
+        return {
+            "type": "summary",
+            "generated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "algorithm": self.algorithm,
+            "groups": sum(1 for group in self.groups if group[2] == "group"),
+            "directory_groups": sum(1 for group in self.groups if group[2] == "directory"),
+            "song_groups": sum(1 for group in self.groups if group[2] == "song"),
+            "files": sum(group[5] for group in self.groups),
+            "wasted_bytes": sum(group[0] for group in self.groups)
+        }
+
+    def write(self, file_path = REPORT_PATH):
+        self.groups.sort(key = lambda group: (-group[0], group[1]))
+        temp_path = file_path + ".tmp"
+
+        # Written to a temporary file first so a reader never sees a half written report
+        with open(temp_path, "w") as file:
+            file.write(json.dumps(self.summary()) + "\n")
+
+            for wasted, digest, kind, size, members, file_count in self.groups:
+                line = {
+                    "type": kind,
+                    "digest": digest,
+                    "size": size,
+                    "wasted_bytes": wasted
+                }
+
+                if kind == "song":
+                    line["directories"] = [{"path": path, "size": folder_size, "file_count": file_count} for path, folder_size, file_count in members]
+                elif kind == "directory":
+                    line["directories"], line["file_count"] = members
+                else:
+                    inodes = [inode_key(record) for record in members]
+                    line["distinct_inodes"] = len(set(inodes))
+                    line["files"] = [{
+                        "path": record["PATH"],
+                        "mtime": record["MODIFIED_TIME"],
+                        "hardlinked": inodes.count(inode_key(record)) > 1 # Already deduplicated with another file in the group
+                    } for record in sorted(members, key = lambda record: record["PATH"])]
+
+                file.write(json.dumps(line) + "\n")
+
+        os.replace(temp_path, file_path)
@@ -0,0 +1,76 @@
+import os
+import re
+import configparser
+from hashing import new_hash
+
+SONG_INI = "song.ini"
+CHART_FILES = ("notes.chart", "notes.mid") # In order of preference when a folder has both
+SONG_KEYS = ("name", "artist", "charter")
+METADATA_KEY = "SONG_METADATA" # Cached on the song.ini record, so it's dropped whenever the file changes
+TAG_PATTERN = re.compile(r"<[^>]*>") # Rich text tags like <color=#FF0000>, often added or removed on re-releases
+
+
+def read_song_metadata(path):
+    """Reads the identifying fields of a song.ini, normalized so formatting and case differences don't matter.
+    Returns an empty string when the file can't be parsed."""
+    parser = configparser.ConfigParser(strict = False, interpolation = None)
+
+    try:
+        with open(path, "r", encoding = "utf-8-sig", errors = "replace") as file:
+            parser.read_file(file)
+    except configparser.Error:
+        return ""
+
+    section = next((parser[name] for name in parser.sections() if name.strip().lower() == "song"), None)
+
+    if section is None:
+        return ""
+
+    values = []
+
+    for key in SONG_KEYS:
+        value = section.get(key) or (section.get("frets", "") if key == "charter" else "") # Older charts use frets
+        values.append(" ".join(TAG_PATTERN.sub("", value).casefold().split()))
+
+    return "\0".join(values)
+
+
+def find_song_folders(records):
+    """Groups records by directory and returns the song folders, directory to (song.ini record, chart record, records)."""
+    directories = {}
+
+    for record in records:
+        directories.setdefault(os.path.dirname(record["PATH"]), []).append(record)
+
+    folders = {}
+
+    for directory, folder_records in directories.items():
+        by_name = {os.path.basename(record["PATH"]).lower(): record for record in folder_records} # Windows charts vary in case
+        chart = next((by_name[name] for name in CHART_FILES if name in by_name), None)
+
+        if SONG_INI in by_name and chart is not None:
+            folders[directory] = (by_name[SONG_INI], chart, folder_records)
+
+    return folders
+
+
+def group_songs(folders, algorithm):
+    """Groups song folders with the same chart and metadata, the audio and images aren't looked at.
+
+    Folders need the chart digest and the song.ini metadata in their records. Returns (fingerprint,
+    directories) groups, directories being (path, size, file count) tuples sorted by path."""
+    groups = {}
+
+    for directory, (ini_record, chart_record, folder_records) in folders.items():
+        metadata = ini_record.get(METADATA_KEY)
+        chart_digest = chart_record.get(algorithm)
+
+        if not metadata or chart_digest is None:
+            continue
+
+        hash_obj = new_hash(algorithm)
+        hash_obj.update(f"{chart_digest}\0{metadata}".encode("utf-8", "surrogateescape"))
+        size = sum(record.get("SIZE", 0) for record in folder_records)
+        groups.setdefault(hash_obj.hexdigest(), []).append((directory, size, len(folder_records)))
+
+    return [(fingerprint, sorted(directories)) for fingerprint, directories in groups.items() if len(directories) > 1]
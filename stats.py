@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import heapq
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+
+STATS_PATH = "./scan_stats.json"
+PROFILE_PATH = "./scan_profile.prof"
+SLOWEST_COUNT = 10
+PROFILE_FUNCTIONS = 25
+
+
+def timed_call(function, *args):
+    # Module level so it can be pickled to a process pool together with the hash function
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+class ScanStats:
+    """Collects wall time per phase, counters and the slowest files and directories of a scan.
+
+    Not thread safe, threads that need stats of their own (the walker) keep a separate ScanStats
+    that's merged into the main one afterwards."""
+    def __init__(self):
+        self.started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.phases = {}
+        self.counters = {}
+        self.slowest = {} # Kind (files, directories) to a min-heap of (seconds, path)
+        self.profile = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_slow(self, kind, path, seconds):
+        heap = self.slowest.setdefault(kind, [])
+
+        if len(heap) < SLOWEST_COUNT:
+            heapq.heappush(heap, (seconds, path))
+        elif seconds > heap[0][0]:
+            heapq.heapreplace(heap, (seconds, path))
+
+    def add_profile(self, profiler, file_path = PROFILE_PATH):
+        """Dumps a cProfile run for pstats/snakeviz and keeps the functions with the most cumulative time."""
+        profiler.dump_stats(file_path)
+        entries = pstats.Stats(profiler).stats # (file, line, function) to (primitive calls, calls, own time, cumulative time, callers)
+        top = sorted(entries.items(), key = lambda item: item[1][3], reverse = True)[:PROFILE_FUNCTIONS]
+
+        self.profile = {
+            "file": os.path.abspath(file_path),
+            "top_cumulative": [{
+                "function": f"{os.path.basename(file)}:{line}({function})",
+                "calls": calls,
+                "own_seconds": round(own_time, 6),
+                "cumulative_seconds": round(cumulative_time, 6)
+            } for (file, line, function), (_, calls, own_time, cumulative_time, _) in top]
+        }
+
+    def merge(self, other):
+        for name, seconds in other.phases.items():
+            self.add_time(name, seconds)
+
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+
+        for kind, heap in other.slowest.items():
+            for seconds, path in heap:
+                self.record_slow(kind, path, seconds)
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "counters": self.counters,
+            "slowest": {kind: [{"path": path, "seconds": round(seconds, 6)} for seconds, path in sorted(heap, reverse = True)] for kind, heap in self.slowest.items()},
+            "profile": self.profile
+        }
+
+    def write(self, file_path = STATS_PATH):
+        temp_path = file_path + ".tmp"
+
+        with open(temp_path, "w") as file:
+            json.dump(self.to_dict(), file, indent = 4)
+
+        os.replace(temp_path, file_path)
@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import cache_manager as cm
+
+
+class LegacyCacheTest(unittest.TestCase):
+    """Caches written before records had a LAST_SEEN load, loaded many loads later."""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        data = {f"f{i}.bin": [{"PATH": os.path.join(self.directory, f"f{i}.bin"), "MODIFIED_TIME": 1.0, "SIZE": 100, "hash_algorithm": "md5"}] for i in range(3)}
+
+        with open(os.path.join(self.directory, "cache.json"), "w") as file:
+            json.dump({"metadata": {"time_created": None, "time_updated": None, "times_loaded": 50, "hash_algorithm": "md5"}, "data": data}, file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, backend, file_name):
+        cache = cm.CacheOperations(["hash_algorithm"], os.path.join(self.directory, file_name), backend)
+        cache.load()
+        cache.ensure_loaded()
+        return cache
+
+    def check_backend(self, backend, file_name):
+        for _ in range(2): # Migrated (or loaded) once, then loaded from the written cache
+            cache = self.load(backend, file_name)
+            self.assertEqual(cache.evict(10), 0)
+            self.assertEqual(len(cache), 3)
+            cache.write()
+            cache.backend.close()
+
+    def test_json(self):
+        self.check_backend("json", "cache.json")
+
+    def test_sqlite(self):
+        self.check_backend("sqlite", "cache.db")
+
+    def test_sharded(self):
+        self.check_backend("sharded", "cache_shards")
+
+    def test_evicted_once_unused(self):
+        self.load("json", "cache.json").write()
+
+        for _ in range(11):
+            cache = self.load("json", "cache.json")
+            cache.write()
+
+        self.assertEqual(cache.evict(10), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+import os
+import time
+from stats import ScanStats
+
+
+def inode_key(record):
+    """Identity of the file behind a cache record, (device, inode) or the path when the inode isn't known."""
+    if not record.get("INODE"):
+        return record["PATH"]
+
+    # DirEntry.stat() leaves st_dev at 0 on Windows, the drive stands in for it there
+    return (record.get("DEVICE") or os.path.splitdrive(record["PATH"])[0].lower(), record["INODE"])
+
+
+class WalkEntry:
+    """Metadata of a walked file, captured from a single stat call."""
+    __slots__ = ("path", "name", "size", "mtime", "inode", "device")
+
+    def __init__(self, path, name, size = None, mtime = None, inode = None, device = None):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.device = device
+
+    def __repr__(self):
+        return f"WalkEntry({self.path!r}, size={self.size}, mtime={self.mtime})"
+
+
+class DirectoryWalker:
+    """Walks directory trees with an explicit stack instead of recursion.
+
+    Every directory iterator is closed before its subdirectories are listed, so the number of open
+    file descriptors doesn't grow with the depth of the tree. Yields ("file", WalkEntry),
+    ("omitted", WalkEntry) and ("error", message) tuples. Symlinks are only followed when
+    follow_symlinks is set, and directories already visited (by device and inode) are skipped
+    so symlink loops can't make the walk go on forever.
+
+    After the items of a directory a ("listed", (path, subdirectories, mtime, entries)) tuple is yielded,
+    entries being the number of files and subdirectories walked. Directories in completed (path to
+    subdirectories, from an interrupted scan) aren't listed again, a ("resumed", path) tuple is yielded
+    instead and the walk continues into the recorded subdirectories. Directories in known (path to
+    (mtime, subdirectories) from an earlier scan) whose mtime hasn't changed are handled the same way
+    with an ("unchanged", path) tuple. A directory that can't be listed yields an error followed by
+    ("unlisted", path), nothing under it is walked. Setting cancelled stops the walk after the current directory."""
+    def __init__(self, exclusions, recursive = False, follow_symlinks = False, completed = None, known = None):
+        self.exclusions = exclusions
+        self.recursive = recursive
+        self.follow_symlinks = follow_symlinks
+        self.completed = completed or {}
+        self.known = known or {}
+        self.cancelled = False
+        self.visited = set()
+        self.stats = ScanStats() # Owned by the walking thread, merged into the scan stats once the walk is done
+
+    def walk(self, roots):
+        for root in roots:
+            if self.exclusions.skip_root(root):
+                yield ("error", f"Scan path \"{root}\" is excluded in settings, skipping it.")
+                continue
+
+            stack = [root]
+
+            while stack and not self.cancelled:
+                path = stack.pop()
+
+                if path in self.completed:
+                    subdirectories = self.completed[path]
+                    yield ("resumed", path)
+                else:
+                    items, subdirectories = self._list_directory(path)
+                    yield from items
+
+                    if subdirectories is None: # Listing failed, so it's listed again on resume
+                        continue
+
+                if self.recursive:
+                    stack.extend(reversed(subdirectories)) # Reversed so they're popped in listing order
+
+    def walk_into(self, roots, work_queue):
+        for item in self.walk(roots):
+            work_queue.put(item)
+
+    def count_files(self, roots):
+        """Cheap pre-count for progress, lists directories without stat calls (the entry type comes with the listing
+        on most platforms) so the size limit and symlink loops aren't considered."""
+        total = 0
+        stack = [root for root in roots if not self.exclusions.skip_root(root)]
+
+        while stack:
+            path = stack.pop()
+
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_symlink() and not self.follow_symlinks:
+                            continue
+
+                        if entry.is_dir():
+                            if self.recursive and not self.exclusions.skip_dir(entry.path, entry.name):
+                                stack.append(entry.path)
+
+                        elif entry.is_file() and not self.exclusions.skip_file(entry.path, entry.name, 0):
+                            total += 1
+
+            except OSError:
+                continue
+
+        return total
+
+    def _list_directory(self, path):
+        # Items are collected before they're yielded, so the iterator is closed and the timing
+        # doesn't include the time spent waiting on whoever consumes the walk.
+        start = time.perf_counter()
+        items = []
+        subdirectories = []
+
+        try:
+            stat = os.stat(path)
+
+            if self._already_visited(stat):
+                return items, subdirectories
+
+            if self._unchanged(path, stat):
+                return [("unchanged", path)], list(self.known[path][1])
+
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        item = self._check_entry(entry)
+                    except OSError as error:
+                        items.append(("error", str(error)))
+                        continue
+
+                    if item is None:
+                        continue
+
+                    if item == "directory":
+                        subdirectories.append(entry.path)
+                    else:
+                        items.append(item)
+
+        except OSError as error:
+            items.append(("error", str(error)))
+            items.append(("unlisted", path))
+            subdirectories = None
+        else:
+            files = sum(1 for kind, _ in items if kind == "file")
+            items.append(("listed", (path, subdirectories, stat.st_mtime, files + len(subdirectories))))
+
+        elapsed = time.perf_counter() - start
+        self.stats.add_time("walk", elapsed)
+        self.stats.count("directories_listed")
+        self.stats.record_slow("directories", path, elapsed)
+        return items, subdirectories
+
+    def _check_entry(self, entry):
+        if entry.is_symlink() and not self.follow_symlinks:
+            self.stats.count("skipped_symlinks")
+            return None
+
+        if entry.is_dir():
+            # Excluded directories are pruned here, nothing under them is listed
+            rule = self._timed_check(self.exclusions.skip_dir, entry.path, entry.name)
+
+            if rule:
+                self.stats.count(f"skipped_by_{rule}")
+                return ("omitted", WalkEntry(entry.path, entry.name))
+
+            return "directory"
+
+        if entry.is_file():
+            stat = entry.stat() # The only stat of the file, everything else uses the WalkEntry
+            walk_entry = WalkEntry(entry.path, entry.name, stat.st_size, stat.st_mtime, stat.st_ino or entry.inode(), stat.st_dev)
+            rule = self._timed_check(self.exclusions.skip_file, entry.path, entry.name, stat.st_size)
+
+            if rule:
+                self.stats.count(f"skipped_by_{rule}")
+                return ("omitted", walk_entry)
+
+            self.stats.count("files_found")
+            return ("file", walk_entry)
+
+        return None
+
+    def _timed_check(self, check, *args):
+        start = time.perf_counter()
+        rule = check(*args)
+        self.stats.add_time("exclusion_checks", time.perf_counter() - start)
+        return rule
+
+    def _already_visited(self, stat):
+        # Only symlinks can lead back into a visited directory, so there's nothing to track without them
+        if not self.follow_symlinks:
+            return False
+
+        key = (stat.st_dev, stat.st_ino)
+
+        if key in self.visited:
+            return True
+
+        self.visited.add(key)
+        return False
+
+    def _unchanged(self, path, stat):
+        # Adding, removing or renaming an entry updates the directory's mtime, editing a file in place doesn't
+        known = self.known.get(path)
+
+        if known is None or known[0] != stat.st_mtime:
+            return False
+
+        self.stats.count("directories_unchanged")
+        return True
@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+from walker import DirectoryWalker
+from report import REPORT_PATH
+from file_operations import FileOperations, ScanInterrupted
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, name length
+
+
+class InotifyWatcher:
+    """Watches every directory under the roots with inotify, called through ctypes.
+
+    events returns ("changed", path), ("removed", path) and ("overflow", None) tuples, a changed
+    directory was created or moved in. New directories get watches of their own, excluded ones (and
+    everything under them) aren't watched. Raises OSError when inotify isn't available or the watch
+    limit (fs.inotify.max_user_watches) is reached."""
+    def __init__(self, roots, exclusions, recursive, follow_symlinks = False):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+        self.exclusions = exclusions
+        self.recursive = recursive
+        self.follow_symlinks = follow_symlinks
+        self.watches = {} # Watch descriptor to directory
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        try:
+            for root in roots:
+                if not exclusions.skip_root(root):
+                    self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        events = []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW: # Events were dropped, only a rescan can tell what changed
+                events.append(("overflow", None))
+                continue
+
+            if mask & IN_IGNORED: # Directory removed or unmounted, the kernel dropped its watch
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name)
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                if mask & IN_ISDIR:
+                    self._unwatch_tree(path)
+
+                events.append(("removed", path))
+
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive and not self.exclusions.skip_dir(path, name):
+                    try:
+                        self._watch_tree(path)
+                    except OSError as error:
+                        if error.errno == errno.ENOSPC:
+                            raise
+
+                    events.append(("changed", path))
+
+            else:
+                events.append(("changed", path))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _watch_tree(self, root):
+        stack = [root]
+
+        while stack:
+            path = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | (0 if self.follow_symlinks else IN_DONT_FOLLOW))
+
+            if wd < 0:
+                error = ctypes.get_errno()
+
+                if error == errno.ENOSPC:
+                    raise OSError(error, "Out of inotify watches, raise fs.inotify.max_user_watches")
+
+                continue # Removed or unreadable since it was listed
+
+            self.watches[wd] = path
+
+            if not self.recursive:
+                continue
+
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks = self.follow_symlinks) and not self.exclusions.skip_dir(entry.path, entry.name):
+                            stack.append(entry.path)
+            except OSError:
+                continue
+
+    def _unwatch_tree(self, path):
+        # A moved directory keeps its watches, but they would report the old paths
+        prefix = os.path.join(path, "")
+
+        for wd, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+
+class PollingWatcher:
+    """Fallback for platforms and filesystems without inotify (network mounts don't deliver events either).
+
+    Walks the roots every interval seconds and compares the size and mtime of every file against the
+    previous walk. Returns the same events as InotifyWatcher, except for directories."""
+    def __init__(self, roots, exclusions, recursive, follow_symlinks = False, interval = 10):
+        self.roots = roots
+        self.exclusions = exclusions
+        self.recursive = recursive
+        self.follow_symlinks = follow_symlinks
+        self.interval = interval
+        self.snapshot = self._snapshot()
+        self.last_poll = time.monotonic()
+
+    def events(self, timeout):
+        remaining = self.interval - (time.monotonic() - self.last_poll)
+
+        if remaining > 0:
+            time.sleep(min(timeout, remaining))
+            return []
+
+        snapshot = self._snapshot()
+        self.last_poll = time.monotonic()
+        events = [("changed", path) for path, state in snapshot.items() if self.snapshot.get(path) != state]
+        events.extend(("removed", path) for path in self.snapshot if path not in snapshot)
+        self.snapshot = snapshot
+        return events
+
+    def close(self):
+        pass
+
+    def _snapshot(self):
+        walker = DirectoryWalker(self.exclusions, self.recursive, self.follow_symlinks)
+        return {entry.path: (entry.size, entry.mtime) for kind, entry in walker.walk(self.roots) if kind == "file"}
+
+
+def create_watcher(roots, exclusions, settings, recursive = True, poll = False):
+    follow_symlinks = settings.get("follow_symlinks", False)
+
+    if not poll:
+        try:
+            return InotifyWatcher(roots, exclusions, recursive, follow_symlinks)
+        except (OSError, AttributeError) as error: # AttributeError when the C library has no inotify functions
+            print(f"inotify isn't available ({error}), polling every {settings.get('watch_poll_interval', 10)} seconds instead.")
+
+    return PollingWatcher(roots, exclusions, recursive, follow_symlinks, settings.get("watch_poll_interval", 10))
+
+
+def watch(fo, roots, recursive = True, poll = False):
+    """Keeps the cache and the duplicates report up to date while files under the roots change.
+
+    Starts with a scan (incremental when the cache knows the directories), then applies the events in
+    batches. A file is only looked at once no event came for it in "watch_debounce" seconds, so files
+    still being written or downloaded aren't hashed halfway. The cache is written every
+    "watch_write_interval" seconds while there are changes, and when watching stops."""
+    debounce = fo.settings.get("watch_debounce", 2)
+    write_interval = fo.settings.get("watch_write_interval", 60)
+
+    fo.scan_directory(roots, recursive)
+    watcher = create_watcher(roots, fo.exclusions, fo.settings, recursive, poll)
+    print(f"Watching {roots} with {type(watcher).__name__}, Ctrl+C to stop.")
+    pending = {} # Path to (kind, time of its last event)
+    last_write = time.monotonic()
+    unwritten = False
+
+    try:
+        while True:
+            for kind, path in watcher.events(min(debounce, 1)):
+                if kind == "overflow":
+                    print("Too many changes at once, rescanning.")
+                    pending.clear()
+                    fo.scan_directory(roots, recursive)
+                    continue
+
+                pending[path] = (kind, time.monotonic())
+
+            now = time.monotonic()
+            settled = [(path, kind) for path, (kind, last_event) in pending.items() if now - last_event >= debounce]
+
+            if settled:
+                for path, _ in settled:
+                    del pending[path]
+
+                changed = [path for path, kind in settled if kind == "changed"]
+                removed = [path for path, kind in settled if kind == "removed"]
+                fo.apply_changes(roots, recursive, changed, removed)
+                unwritten = True
+                print(f"{len(changed)} changed, {len(removed)} removed, duplicates report {'has duplicates' if fo.detected else 'is empty'}.")
+
+                for error in fo.error_dump:
+                    print(f"   {error}")
+
+                fo.error_dump = []
+
+            if unwritten and now - last_write >= write_interval:
+                fo.cache.write()
+                last_write = now
+                unwritten = False
+
+    except (KeyboardInterrupt, ScanInterrupted): # The latter when stopped during a rescan
+        pass
+    finally:
+        watcher.close()
+
+        if unwritten:
+            fo.cache.write()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Scans paths and keeps the duplicates report up to date while they change.")
+    parser.add_argument("paths", nargs = "+")
+    parser.add_argument("--no-recursive", action = "store_true")
+    parser.add_argument("--poll", action = "store_true", help = "Poll for changes instead of using inotify")
+    args = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "settings.json"), "r") as file:
+        settings = json.load(file)
+
+    fo = FileOperations(settings)
+    watch(fo, [os.path.abspath(path) for path in args.paths], not args.no_recursive, args.poll)
+    print(f"Stopped watching, see \"{os.path.abspath(REPORT_PATH)}\".")
+
+
+if __name__ == "__main__":
+    main()